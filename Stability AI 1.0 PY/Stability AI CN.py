@@ -1,78 +1,76 @@
+import collections
+import functools
+import itertools
 import json
-import math
 import os
-import requests
+import queue
 import sys
 import random
-import platform
-import webbrowser
-try:
-    import DaVinciResolveScript as dvr_script
-    from python_get_resolve import GetResolve
-    print("DaVinciResolveScript from Python")
-except ImportError:
-    
-    if platform.system() == "Darwin": 
-        resolve_script_path1 = "/Library/Application Support/Blackmagic Design/DaVinci Resolve/Developer/Scripting/Examples"
-        resolve_script_path2 = "/Library/Application Support/Blackmagic Design/DaVinci Resolve/Developer/Scripting/Modules"
-    elif platform.system() == "Windows": 
-        resolve_script_path1 = os.path.join(os.environ['PROGRAMDATA'], "Blackmagic Design", "DaVinci Resolve", "Support", "Developer", "Scripting", "Examples")
-        resolve_script_path2 = os.path.join(os.environ['PROGRAMDATA'], "Blackmagic Design", "DaVinci Resolve", "Support", "Developer", "Scripting", "Modules")
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# 启动计时：记录每个阶段的耗时，窗口显示后打印，便于发现启动变慢
+startup_phases = []
+startup_clock = time.perf_counter()
+
+def mark_startup(phase):
+    global startup_clock
+    now = time.perf_counter()
+    startup_phases.append((phase, now - startup_clock))
+    startup_clock = now
+
+def print_startup_timing():
+    total = sum(seconds for _, seconds in startup_phases)
+    phases = ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in startup_phases)
+    print(f"Startup: {phases} (total {total * 1000:.0f} ms)")
+
+def get_script_path():
+    # 使用 sys.argv 获取脚本路径
+    if len(sys.argv) > 0:
+        return os.path.dirname(os.path.abspath(sys.argv[0]))
     else:
-        raise EnvironmentError("Unsupported operating system")
+        return os.getcwd()
 
-    sys.path.append(resolve_script_path1)
-    sys.path.append(resolve_script_path2)
+script_path = get_script_path()
+
+# 生成引擎和 Resolve 插件与脚本放在同一目录
+sys.path.insert(0, script_path)
+from stability_engine import (
+    HISTORY_PAGE_SIZE, HTTP_POOL_SIZE, MAX_CONCURRENCY, MAX_SAMPLES, MAX_SWEEP_JOBS, METRICS_FILE, SAMPLERS, STYLE_PRESETS,
+    JobJournal, JobTrace, LazyModule,
+    StabilityAPIError, allocate_output_file, allocate_sequence_name, close_http_session, compose_contact_sheet, contact_sheet_supported,
+    credit_tracker, estimate_credits, expand_batch, expand_sweep, generate_image_v1, generate_image_v2, generation_history,
+    get_key_pool, is_offline_error, make_thumbnail, mask_api_key, metrics, parse_api_keys, parse_count, parse_sweep, queue_job,
+    release_output_file, run_traced, set_http_pool_size, set_status_handler, sweep_fields_v1, sweep_fields_v2,
+)
+from stability_resolve import FusionLoaderBatcher, MediaPoolImporter, TimelinePlacer, import_resolve_scripting
+
+# 只有点击链接按钮时才需要
+webbrowser = LazyModule("webbrowser")
+# 只有勾选后台服务或填写任务服务器时才需要
+stability_daemon = LazyModule("stability_daemon")
+stability_server = LazyModule("stability_server")
+mark_startup("imports")
+
+dvr_script, GetResolve = import_resolve_scripting()
 
-    try:
-        import DaVinciResolveScript as dvr_script
-        from python_get_resolve import GetResolve
-        print("DaVinciResolveScript from DaVinci")
-    except ImportError as e:
-        raise ImportError("Unable to import DaVinciResolveScript or python_get_resolve after adding paths") from e
-    
 # 获取Resolve实例
 resolve = GetResolve()
 ui = fusion.UIManager
 dispatcher = bmd.UIDispatcher(ui)
+# 脚本在 UI 线程上加载，后台线程不能直接操作界面
+ui_thread_id = threading.get_ident()
+mark_startup("resolve")
 
-def load_image_in_fusion(image_path):
-    comp = fusion.GetCurrentComp()
-    comp.Lock()
-    loader = comp.AddTool("Loader")
-    loader.Clip[comp.CurrentTime] = image_path
-    loader.SetAttrs({"TOOLS_RegenerateCache": True})
-    comp.Unlock()
-
-def add_to_media_pool(filename):
-    # 获取Resolve实例
-    resolve = dvr_script.scriptapp("Resolve")
-    project_manager = resolve.GetProjectManager()
-    project = project_manager.GetCurrentProject()
-    media_pool = project.GetMediaPool()
-    root_folder = media_pool.GetRootFolder()
-    ai_image_folder = None
-
-    # 检查 AiImage 文件夹是否已存在
-    folders = root_folder.GetSubFolderList()
-    for folder in folders:
-        if folder.GetName() == "AiImage":
-            ai_image_folder = folder
-            break
-
-    if not ai_image_folder:
-        ai_image_folder = media_pool.AddSubFolder(root_folder, "AiImage")
-
-    if ai_image_folder:
-        print(f"AiImage folder is available: {ai_image_folder.GetName()}")
-    else:
-        print("Failed to create or find AiImage folder.")
-        return False
-
-    media_storage = resolve.GetMediaStorage()
-    mapped_path = filename
-    media_pool.SetCurrentFolder(ai_image_folder)
-    return media_pool.ImportMedia([mapped_path], ai_image_folder)
+# 媒体池和 Fusion 导入由 stability_resolve 插件完成
+media_pool_importer = MediaPoolImporter(resolve)
+fusion_loader_batcher = FusionLoaderBatcher(fusion)
 
 def check_or_create_file(file_path):
     if os.path.exists(file_path):
@@ -84,38 +82,111 @@ def check_or_create_file(file_path):
         except IOError:
             raise Exception(f"Cannot create file: {file_path}")
 
-def get_script_path():
-    # 使用 sys.argv 获取脚本路径
-    if len(sys.argv) > 0:
-        return os.path.dirname(os.path.abspath(sys.argv[0]))
-    else:
-        return os.getcwd()
-
-script_path = get_script_path()
-
 settings_file = os.path.join(script_path, 'Stability_settings.json')
 
 check_or_create_file(settings_file)
 
+# 设置文件版本：1 把种子、尺寸等保存为数字，2 起与输入框一致保存文本
+SETTINGS_SCHEMA_VERSION = 2
+SETTINGS_TEXT_KEYS = ("SEED_V1", "SEED_V2", "CFG_SCALE", "HEIGHT", "WIDTH", "SAMPLES", "STEPS")
+
+def parse_settings(content):
+    # 先按完整 JSON 解析；文件被截断或损坏时逐个键值对抢救，能读出多少算多少
+    try:
+        settings = json.loads(content)
+        if isinstance(settings, dict):
+            return settings, True
+    except ValueError:
+        pass
+    decoder = json.JSONDecoder()
+    settings = {}
+    for match in re.finditer(r'"([A-Z0-9_]+)"\s*:\s*', content):
+        try:
+            settings[match.group(1)] = decoder.raw_decode(content, match.end())[0]
+        except ValueError:
+            continue
+    return settings, False
+
+def migrate_settings(settings):
+    if settings.get("SCHEMA_VERSION", 1) < 2:
+        for key in SETTINGS_TEXT_KEYS:
+            if isinstance(settings.get(key), (int, float)):
+                settings[key] = str(settings[key])
+    # 缺失或类型不符的值（例如手工编辑过的文件）回退为默认值，避免启动时出错
+    migrated = dict(default_settings)
+    for key, default in default_settings.items():
+        if key in settings and type(settings[key]) is type(default):
+            migrated[key] = settings[key]
+    return migrated
+
 def load_settings(settings_file):
-    if os.path.exists(settings_file):
+    try:
         with open(settings_file, 'r') as file:
             content = file.read()
-            if content:
-                try:
-                    settings = json.loads(content)
-                    return settings
-                except json.JSONDecodeError as err:
-                    print('Error decoding settings:', err)
-                    return None
-    return None
+    except OSError as e:
+        print(f"Error reading settings: {e}")
+        return None
+    if not content.strip():
+        return None
+    settings, complete = parse_settings(content)
+    if not complete:
+        # 保留损坏的原文件，下次保存时写入抢救出来的设置
+        print(f"Settings file is damaged, recovered {len(settings)} value(s).")
+        try:
+            shutil.copyfile(settings_file, settings_file + '.corrupt')
+        except OSError as e:
+            print(f"Error backing up settings: {e}")
+    return migrate_settings(settings)
 
 def save_settings(settings, settings_file):
-    with open(settings_file, 'w') as file:
-        content = json.dumps(settings, indent=4)
-        file.write(content)
+    # 写入同目录的临时文件后原子替换，写到一半崩溃也不会损坏原文件
+    directory = os.path.dirname(settings_file) or "."
+    fd, temp_path = tempfile.mkstemp(prefix=".Stability_settings-", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(dict(settings, SCHEMA_VERSION=SETTINGS_SCHEMA_VERSION), file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, settings_file)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+# 自动保存：字段变化只做标记，最后一次修改后静默一段时间再由 PollTimer 写入
+SETTINGS_AUTOSAVE_DELAY = 1.5
+
+class SettingsAutosaver:
+    def __init__(self, settings_file, delay=SETTINGS_AUTOSAVE_DELAY):
+        self.settings_file = settings_file
+        self.delay = delay
+        self.changed_at = None
+        self.last_saved = None
+
+    def touch(self):
+        self.changed_at = time.monotonic()
+
+    def poll(self, collect):
+        if self.changed_at is None or time.monotonic() - self.changed_at < self.delay:
+            return
+        self.changed_at = None
+        self.save(collect())
+
+    def save(self, settings):
+        # 内容没变时不写磁盘
+        if settings == self.last_saved:
+            return
+        try:
+            save_settings(settings, self.settings_file)
+        except OSError as e:
+            print(f"Error saving settings: {e}")
+            return
+        self.last_saved = settings
+
+settings_autosaver = SettingsAutosaver(settings_file)
 
-saved_settings = load_settings(settings_file) 
 
 default_settings = {
     "USE_DR": True,
@@ -140,9 +211,26 @@ default_settings = {
     "WIDTH": '512',
     "SAMPLER": 0,
     "SAMPLES": '1',
-    "STEPS": '30'
+    "STEPS": '30',
+    "BATCH_V1": False,
+    "BATCH_V2": False,
+    "BATCH_COUNT_V1": '1',
+    "BATCH_COUNT_V2": '1',
+    "CONCURRENCY": '2',
+    "USE_DAEMON": False,
+    "JOB_SERVER": '',
+    "SWEEP_V1": False,
+    "SWEEP_V2": False,
+    "SWEEP_GRID_V1": '',
+    "SWEEP_GRID_V2": '',
+    "APPEND_TO_TIMELINE": False,
+    "TIMELINE_TRACK": '1',
+    "STILL_DURATION": '120'
 }
 
+saved_settings = load_settings(settings_file)
+mark_startup("settings")
+
 
 infomsg = """
    <!DOCTYPE html>
@@ -265,7 +353,7 @@ win = dispatcher.AddWindow(
                                     {"Weight": 0.1},
                                     [
                                         ui.Label({"ID": 'SamplesLabel', "Text": '数量', "Alignment": {"AlignRight": False}, "Weight": 0.2}),
-                                        ui.LineEdit({"ID": 'Samples', "Text": '1', "Weight": 0.8, "ReadOnly": True}),
+                                        ui.LineEdit({"ID": 'Samples', "Text": '1', "Weight": 0.8}),
                                     ]
                                 ),
                                 ui.HGroup(
@@ -282,6 +370,21 @@ win = dispatcher.AddWindow(
                                         ui.LineEdit({"ID": 'Seed', "Text": '0', "Weight": 0.8}),
                                     ]
                                 ),
+                                ui.HGroup(
+                                    {"Weight": 0.1},
+                                    [
+                                        ui.CheckBox({"ID": 'BatchV1', "Text": '批量（每行一个提示词）', "Checked": False, "Weight": 0.6}),
+                                        ui.Label({"ID": 'BatchCountLabel', "Text": '张数', "Alignment": {"AlignRight": True}, "Weight": 0.2}),
+                                        ui.LineEdit({"ID": 'BatchCountV1', "Text": '1', "Weight": 0.2}),
+                                    ]
+                                ),
+                                ui.HGroup(
+                                    {"Weight": 0.1},
+                                    [
+                                        ui.CheckBox({"ID": 'SweepV1', "Text": '参数扫描', "Checked": False, "Weight": 0.2}),
+                                        ui.LineEdit({"ID": 'SweepGridV1', "Text": '', "PlaceholderText": 'seed=1,2; cfg=5,7; steps=20,40; sampler=*', "Weight": 0.8}),
+                                    ]
+                                ),
                                 ui.HGroup(
                                     {"Weight": 0.1},
                                     [
@@ -368,6 +471,21 @@ win = dispatcher.AddWindow(
                                         ui.LineEdit({"ID": 'SeedV2', "Text": '0', "Weight": 0.8}),
                                     ]
                                 ),
+                                ui.HGroup(
+                                    {"Weight": 0.1},
+                                    [
+                                        ui.CheckBox({"ID": 'BatchV2', "Text": '批量（每行一个提示词）', "Checked": False, "Weight": 0.6}),
+                                        ui.Label({"ID": 'BatchCountLabel', "Text": '张数', "Alignment": {"AlignRight": True}, "Weight": 0.2}),
+                                        ui.LineEdit({"ID": 'BatchCountV2', "Text": '1', "Weight": 0.2}),
+                                    ]
+                                ),
+                                ui.HGroup(
+                                    {"Weight": 0.1},
+                                    [
+                                        ui.CheckBox({"ID": 'SweepV2', "Text": '参数扫描', "Checked": False, "Weight": 0.2}),
+                                        ui.LineEdit({"ID": 'SweepGridV2', "Text": '', "PlaceholderText": 'seed=1,2,3; style=*', "Weight": 0.8}),
+                                    ]
+                                ),
                                 ui.HGroup(
                                     {"Weight": 0.1},
                                     [
@@ -423,10 +541,17 @@ win = dispatcher.AddWindow(
                                     {"Weight": 0.05},
                                     [
                                         ui.Label({"ID": 'ApiKeyLabel', "Text": 'API 密钥', "Alignment": {"AlignRight": False}, "Weight": 0.2}),
-                                        ui.LineEdit({"ID": 'ApiKey', "Text": '', "EchoMode": 'Password', "Weight": 0.6}),
+                                        ui.LineEdit({"ID": 'ApiKey', "Text": '', "PlaceholderText": '多个 Key 用逗号分隔', "EchoMode": 'Password', "Weight": 0.6}),
                                         ui.Button({"ID": 'Balance', "Text": '余额', "Weight": 0.2}),
                                     ]
                                 ),
+                                ui.HGroup(
+                                    {"Weight": 0.05},
+                                    [
+                                        ui.Label({"ID": 'JobServerLabel', "Text": '任务服务器', "Alignment": {"AlignRight": False}, "Weight": 0.2}),
+                                        ui.LineEdit({"ID": 'JobServer', "Text": '', "PlaceholderText": 'http://主机:8700，留空则在本机生成', "Weight": 0.8}),
+                                    ]
+                                ),
                                 ui.HGroup(
                                     {"Weight": 0.05},
                                     [
@@ -434,9 +559,33 @@ win = dispatcher.AddWindow(
                                     ]
                                 ),
                                 ui.HGroup(
-                                    {"Weight": 0.85},
+                                    {"Weight": 0.05},
                                     [
-                                        ui.TextEdit({"ID": 'infoTxt', "Text": infomsg, "ReadOnly": True}),
+                                        ui.Label({"ID": 'ConcurrencyLabel', "Text": '并发数', "Alignment": {"AlignRight": False}, "Weight": 0.2}),
+                                        ui.LineEdit({"ID": 'Concurrency', "Text": '2', "Weight": 0.4}),
+                                        ui.CheckBox({"ID": 'DaemonCheckBox', "Text": '后台服务', "Checked": False, "Weight": 0.4}),
+                                    ]
+                                ),
+                                ui.HGroup(
+                                    {"Weight": 0.05},
+                                    [
+                                        ui.CheckBox({"ID": 'TimelineCheckBox', "Text": '追加到时间线', "Checked": False, "Weight": 0.4}),
+                                        ui.Label({"ID": 'TimelineTrackLabel', "Text": '轨道', "Alignment": {"AlignRight": True}, "Weight": 0.1}),
+                                        ui.LineEdit({"ID": 'TimelineTrack', "Text": '1', "Weight": 0.15}),
+                                        ui.Label({"ID": 'StillDurationLabel', "Text": '帧数', "Alignment": {"AlignRight": True}, "Weight": 0.15}),
+                                        ui.LineEdit({"ID": 'StillDuration', "Text": '120', "Weight": 0.2}),
+                                    ]
+                                ),
+                                ui.HGroup(
+                                    {"Weight": 0.1},
+                                    [
+                                        ui.Label({"ID": 'MetricsLabel', "Text": '', "Alignment": {"AlignLeft": True, "AlignVCenter": True}, "WordWrap": True}),
+                                    ]
+                                ),
+                                ui.HGroup(
+                                    {"Weight": 0.7},
+                                    [
+                                        ui.TextEdit({"ID": 'infoTxt', "Text": '', "ReadOnly": True}),
                                     ]
                                 ),
                                 ui.Button(
@@ -453,6 +602,26 @@ win = dispatcher.AddWindow(
                                 ),
                             ]
                         ),
+                        ui.VGroup(
+                            [
+                                ui.HGroup(
+                                    {"Weight": 0.05},
+                                    [
+                                        ui.LineEdit({"ID": 'HistorySearch', "Text": '', "PlaceholderText": '搜索提示词', "Weight": 0.8}),
+                                        ui.Button({"ID": 'HistorySearchButton', "Text": '搜索', "Weight": 0.2}),
+                                    ]
+                                ),
+                                ui.Tree({"ID": 'HistoryTree', "AlternatingRowColors": True, "RootIsDecorated": False, "Weight": 0.9}),
+                                ui.HGroup(
+                                    {"Weight": 0.05},
+                                    [
+                                        ui.Button({"ID": 'HistoryPrev', "Text": '上一页', "Enabled": False, "Weight": 0.25}),
+                                        ui.Label({"ID": 'HistoryPageLabel', "Text": '', "Alignment": {"AlignHCenter": True, "AlignVCenter": True}, "Weight": 0.5}),
+                                        ui.Button({"ID": 'HistoryNext', "Text": '下一页', "Enabled": False, "Weight": 0.25}),
+                                    ]
+                                ),
+                            ]
+                        ),
                     ]
                 ),
             ]
@@ -461,12 +630,36 @@ win = dispatcher.AddWindow(
 )
 
 itm = win.GetItems()
+mark_startup("window")
 itm["MyStack"].CurrentIndex = 0
 itm["MyTabs"].AddTab("文生图 V1")
 itm["MyTabs"].AddTab("文生图 V2")
 itm["MyTabs"].AddTab("配置")
+itm["MyTabs"].AddTab("历史记录")
+
+# 启动时不可见的页面（配置页的说明、历史页）在第一次切换过去时才填充
+populated_tabs = set()
+
+def populate_tab(index):
+    if index in populated_tabs:
+        return
+    populated_tabs.add(index)
+    if index == 2:
+        itm["infoTxt"].Text = infomsg
+    elif index == 3:
+        itm["HistoryTree"].ColumnCount = 5
+        history_header = itm["HistoryTree"].NewItem()
+        for column, title in enumerate(["时间", "模型", "种子", "提示词", "文件"]):
+            history_header.Text[column] = title
+        itm["HistoryTree"].SetHeaderItem(history_header)
+
 def on_my_tabs_current_changed(ev):
     itm["MyStack"].CurrentIndex = ev["Index"]
+    populate_tab(ev["Index"])
+    if ev["Index"] == 2:
+        update_metrics_panel()
+    if ev["Index"] == 3:
+        show_history_page()
 win.On.MyTabs.CurrentChanged = on_my_tabs_current_changed
 
 
@@ -481,14 +674,15 @@ def on_model_combo_current_index_changed(ev):
     elif itm["ModelCombo"].CurrentIndex == 1:
         engine_id = "stable-diffusion-xl-1024-v1-0"
     print(f'Using Model: {itm["ModelCombo"].CurrentText}')
+    settings_autosaver.touch()
 win.On.ModelCombo.CurrentIndexChanged = on_model_combo_current_index_changed
 
-samplers = ['DDIM', 'DDPM', 'K_DPMPP_2M', 'K_DPMPP_2S_ANCESTRAL', 'K_DPM_2', 'K_DPM_2_ANCESTRAL', 'K_EULER', 'K_EULER_ANCESTRAL', 'K_HEUN', 'K_LMS']
-for sampler in samplers:
+for sampler in SAMPLERS:
     itm["SamplerCombo"].AddItem(sampler)
 
 def on_sampler_combo_current_index_changed(ev):
     print(f'Using Sampler: {itm["SamplerCombo"].CurrentText}')
+    settings_autosaver.touch()
 win.On.SamplerCombo.CurrentIndexChanged = on_sampler_combo_current_index_changed
 
 models = ['Stable Image Ultra','Stable Image Core', 'Stable Diffusion 3 Large', 'Stable Diffusion 3 Large Turbo','Stable Diffusion 3 Medium']
@@ -525,7 +719,7 @@ def get_style_preset_cn(style):
 
 def get_style_preset_en(chinese_style):
     return style_presets_mapping_reverse.get(chinese_style, chinese_style)
-for style in style_presets_mapping:
+for style in STYLE_PRESETS:
     itm["StyleCombo"].AddItem(get_style_preset_cn(style))
     itm["StyleComboV1"].AddItem(get_style_preset_cn(style))
 
@@ -543,6 +737,7 @@ def on_dr_checkbox_clicked(ev):
         print("Using in Fusion Studio")
     else:
         print("Using in DaVinci Resolve")
+    settings_autosaver.touch()
 win.On.DRCheckBox.Clicked = on_dr_checkbox_clicked
 def on_fu_checkbox_clicked(ev):
     itm["DRCheckBox"].Checked = not itm["FUCheckBox"].Checked
@@ -550,6 +745,7 @@ def on_fu_checkbox_clicked(ev):
         print("Using in Fusion Studio")
     else:
         print("Using in DaVinci Resolve")
+    settings_autosaver.touch()
 win.On.FUCheckBox.Clicked = on_fu_checkbox_clicked
 
 model_id = None
@@ -602,17 +798,19 @@ def on_model_combo_v2_current_index_changed(ev):
     print(f'Using Model: {itm["ModelComboV2"].CurrentText}')
 
     update_output_formats()
+    settings_autosaver.touch()
 win.On.ModelComboV2.CurrentIndexChanged = on_model_combo_v2_current_index_changed
 
 
 def on_aspect_ratio_combo_current_index_changed(ev):
     print(f'Using Aspect_Ratio: {itm["AspectRatioCombo"].CurrentText}')
+    settings_autosaver.touch()
 win.On.AspectRatioCombo.CurrentIndexChanged = on_aspect_ratio_combo_current_index_changed
 
 
 def on_output_format_combo_current_index_changed(ev):
     # print(f'Using Output_Format: {itm["OutputFormatCombo"].CurrentText}')
-    pass
+    settings_autosaver.touch()
 win.On.OutputFormatCombo.CurrentIndexChanged = on_output_format_combo_current_index_changed
 
 
@@ -623,9 +821,34 @@ win.On.OpenLinkButton.Clicked = on_open_link_button_clicked
 
 # 更新状态
 def update_status(message):
+    if threading.get_ident() != ui_thread_id:
+        run_on_ui_thread(update_status, message)
+        return
     itm["StatusLabel1"].Text = message
     itm["StatusLabel2"].Text = message
 
+# 引擎的状态消息是英文，显示前翻译
+engine_status_translations = [
+    (r"^Generating image\.\.\.$", "图像生成中..."),
+    (r"^Image generated successfully\.$", "图像生成成功."),
+    (r"^(\d+) images generated successfully\.$", r"\1 张图像生成成功."),
+    (r"^Failed to generate image: ", "图像生成失败: "),
+    (r"^Image loaded from cache\.$", "已从缓存加载图像."),
+    (r"^Prompt was rejected by content moderation before\.$", "该提示词之前已被内容审核拒绝."),
+    (r"^No usable samples were returned\.$", "没有返回可用的图像."),
+]
+
+def update_engine_status(message):
+    # 任务中的消息带有 [追踪 ID] 前缀，只翻译后面的部分
+    prefix, message = re.match(r"^(\[[0-9a-f]+\] )?(.*)$", message, re.S).groups()
+    for pattern, replacement in engine_status_translations:
+        message, count = re.subn(pattern, replacement, message)
+        if count:
+            break
+    update_status((prefix or "") + message)
+
+set_status_handler(update_engine_status)
+
 if saved_settings:
     itm["DRCheckBox"].Checked = saved_settings.get("USE_DR", default_settings["USE_DR"])
     itm["FUCheckBox"].Checked = saved_settings.get("USE_FU", default_settings["USE_FU"])
@@ -650,6 +873,32 @@ if saved_settings:
     itm["RandomSeed"].Checked = saved_settings.get("USE_RANDOM_SEED_V1", default_settings["USE_RANDOM_SEED_V1"])
     itm["ModelCombo"].CurrentIndex = saved_settings.get("MODEL_V1", default_settings["MODEL_V1"])
     itm["SamplerCombo"].CurrentIndex = saved_settings.get("SAMPLER", default_settings["SAMPLER"])
+    itm["BatchV1"].Checked = saved_settings.get("BATCH_V1", default_settings["BATCH_V1"])
+    itm["BatchV2"].Checked = saved_settings.get("BATCH_V2", default_settings["BATCH_V2"])
+    itm["BatchCountV1"].Text = str(saved_settings.get("BATCH_COUNT_V1", default_settings["BATCH_COUNT_V1"]))
+    itm["BatchCountV2"].Text = str(saved_settings.get("BATCH_COUNT_V2", default_settings["BATCH_COUNT_V2"]))
+    itm["Concurrency"].Text = str(saved_settings.get("CONCURRENCY", default_settings["CONCURRENCY"]))
+    itm["DaemonCheckBox"].Checked = saved_settings.get("USE_DAEMON", default_settings["USE_DAEMON"])
+    itm["JobServer"].Text = saved_settings.get("JOB_SERVER", default_settings["JOB_SERVER"])
+    itm["SweepV1"].Checked = saved_settings.get("SWEEP_V1", default_settings["SWEEP_V1"])
+    itm["SweepV2"].Checked = saved_settings.get("SWEEP_V2", default_settings["SWEEP_V2"])
+    itm["SweepGridV1"].Text = saved_settings.get("SWEEP_GRID_V1", default_settings["SWEEP_GRID_V1"])
+    itm["SweepGridV2"].Text = saved_settings.get("SWEEP_GRID_V2", default_settings["SWEEP_GRID_V2"])
+    itm["TimelineCheckBox"].Checked = saved_settings.get("APPEND_TO_TIMELINE", default_settings["APPEND_TO_TIMELINE"])
+    itm["TimelineTrack"].Text = str(saved_settings.get("TIMELINE_TRACK", default_settings["TIMELINE_TRACK"]))
+    itm["StillDuration"].Text = str(saved_settings.get("STILL_DURATION", default_settings["STILL_DURATION"]))
+
+# 字段变化时标记待保存；已有事件处理的控件在各自的处理函数中标记
+def on_setting_changed(ev):
+    settings_autosaver.touch()
+
+for widget_id in ['PromptTxt', 'PromptTxtV2', 'NegativePromptTxt', 'Width', 'Height', 'CfgScale', 'Samples', 'Steps', 'Seed', 'SeedV2',
+                  'BatchCountV1', 'BatchCountV2', 'SweepGridV1', 'SweepGridV2', 'Path', 'ApiKey', 'JobServer', 'Concurrency', 'TimelineTrack', 'StillDuration']:
+    getattr(win.On, widget_id).TextChanged = on_setting_changed
+for widget_id in ['BatchV1', 'BatchV2', 'SweepV1', 'SweepV2', 'RandomSeed', 'RandomSeedV2', 'TimelineCheckBox']:
+    getattr(win.On, widget_id).Clicked = on_setting_changed
+for widget_id in ['StyleCombo', 'StyleComboV1']:
+    getattr(win.On, widget_id).CurrentIndexChanged = on_setting_changed
 
 
 def show_warning_message(text):
@@ -687,150 +936,589 @@ def show_warning_message(text):
     dispatcher.RunLoop()
     msgbox.Hide()
 
-def get_remaining_credits(api_key: str) -> float:
-    api_host = 'https://api.stability.ai'
-    url = f"{api_host}/v1/user/balance"
+def check_credits(api_key, model, images):
+    # 使用任务服务器时积分由服务器统一管理；多个 Key 时按所有可用 Key 的余额合计检查
+    if itm["JobServer"].Text.strip():
+        return True
+    balance = get_key_pool(api_key).total_credits()
+    if balance is None:
+        return True
+    needed = estimate_credits(model, images)
+    if needed > balance:
+        show_warning_message(f"积分不足: 预计需要 {needed:g}，剩余 {balance:g}。")
+        return False
+    return True
+
+# 后台生成：点击只负责入队，结果通过 PollTimer 回到 UI 线程
+ui_queue = queue.Queue()
+generation_executor = None
+generation_workers = 0
+
+job_ids = itertools.count(1)
+job_states = {}
+job_states_lock = threading.Lock()
+
+def run_on_ui_thread(func, *args):
+    ui_queue.put((func, args))
+
+def get_generation_executor(workers):
+    global generation_executor, generation_workers
+    if generation_executor is None or workers != generation_workers:
+        if generation_executor is not None:
+            # 已提交到旧线程池的任务仍会执行完
+            generation_executor.shutdown(wait=False)
+        generation_executor = ThreadPoolExecutor(max_workers=workers)
+        generation_workers = workers
+        set_http_pool_size(max(HTTP_POOL_SIZE, workers))
+    return generation_executor
+
+def set_job_state(job_id, state):
+    with job_states_lock:
+        job_states[job_id] = state
+        counts = {"queued": 0, "running": 0, "done": 0, "failed": 0, "offline": 0}
+        for job_state in job_states.values():
+            counts[job_state] += 1
+        total = len(job_states)
+        if counts["done"] + counts["failed"] + counts["offline"] == total:
+            job_states.clear()
+    print(f"Job {job_id}: {state}")
+    if total > 1:
+        message = f"队列: {counts['done']} 完成, {counts['running']} 生成中, {counts['queued']} 等待, {counts['failed']} 失败"
+        if counts["offline"]:
+            message += f", {counts['offline']} 离线"
+        update_status(message)
+
+def deliver_images(image_paths, use_dr, sequence=None):
+    # 媒体池和 Fusion 导入都由 PollTimer 按刷新周期合并执行
+    if use_dr:
+        if image_paths:
+            media_pool_importer.add(image_paths)
+    else:
+        fusion_loader_batcher.add(image_paths, sequence)
 
-    response = requests.get(url, headers={
-        "Authorization": f"Bearer {api_key}"
-    })
+def assign_sequence(jobs, model, use_dr):
+    # 在 Fusion 中使用时，把批量结果编号为帧序列，由一个 Loader 加载
+    if use_dr or len(jobs) < 2:
+        return
+    name = allocate_sequence_name(model)
+    fusion_loader_batcher.expect_sequence(name, len(jobs))
+    for frame, job in enumerate(jobs, 1):
+        job["SEQUENCE"] = (name, frame)
+
+# 等待导入的图片 -> 追踪记录列表（命中缓存时多个任务返回同一个文件），导入完成后补上导入耗时再写入日志（只在 UI 线程访问）
+import_traces = {}
+# 任务 -> 尚未导入的图片；合并导入成功后才在任务日志中记为已导入，失败时任务保持待导入，下次启动时补做
+import_jobs = {}
+# 等待放到时间线上的新生成图片
+timeline_paths = set()
+
+def deliver_job(job_key, image_paths, use_dr, sequence=None, trace=None):
+    if trace is not None:
+        for path in image_paths:
+            import_traces.setdefault(path, []).append(trace)
+    if image_paths:
+        import_jobs.setdefault(job_key, set()).update(image_paths)
+        if trace is not None and use_dr:
+            timeline_paths.update(os.path.normpath(path) for path in image_paths)
+    deliver_images(image_paths, use_dr, sequence)
+
+def finish_import_jobs(filenames, ok):
+    flushed = set(filenames)
+    for job_key, paths in list(import_jobs.items()):
+        if not paths & flushed:
+            continue
+        if not ok:
+            del import_jobs[job_key]
+            continue
+        paths -= flushed
+        if not paths:
+            del import_jobs[job_key]
+            job_journal.append(job_key, "imported")
+
+def finish_import_traces(stage, filenames, seconds, ok):
+    if ok:
+        metrics.record_import(seconds, len(filenames))
+    # 一次合并导入可能包含多个任务，每个任务都记入整批的耗时
+    traces = []
+    for filename in filenames:
+        for trace in import_traces.pop(filename, []):
+            if trace not in traces:
+                traces.append(trace)
+    for trace in traces:
+        trace.add(stage, seconds)
+        trace.update(import_batch=len(filenames))
+        trace.finish("imported" if ok else "import_failed")
+
+def on_media_pool_flushed(filenames, seconds, ok):
+    finish_import_traces("import", filenames, seconds, ok)
+    finish_import_jobs(filenames, ok)
+
+def on_fusion_flushed(filenames, seconds, ok):
+    finish_import_traces("fusion_load", filenames, seconds, ok)
+    finish_import_jobs(filenames, ok)
+
+media_pool_importer.add_flush_listener(on_media_pool_flushed)
+fusion_loader_batcher.add_flush_listener(on_fusion_flushed)
+
+def defer_offline_job(job_id, job_key, trace, generate, args, use_dr, on_result, error):
+    # API 暂时不可用：任务留在日志中，恢复后重新提交
+    job_journal.append(job_key, "offline", error=str(error))
+    defer_job(job_key, generate, args, use_dr, on_result)
+    update_status(f"[{trace.trace_id}] API 无法访问，恢复后将重新提交该任务.")
+    print(f"Error: {error}")
+    trace.finish("offline")
+    set_job_state(job_id, "offline")
+
+def run_generation_job(job_id, job_key, trace, generate, args, use_dr, on_result=None):
+    set_job_state(job_id, "running")
+    job_journal.append(job_key, "running", trace=trace.trace_id)
+    try:
+        image_paths = run_traced(trace, generate, args)
+    except StabilityAPIError as e:
+        if is_offline_error(e):
+            defer_offline_job(job_id, job_key, trace, generate, args, use_dr, on_result, e)
+            return
+        # 没有可用的 Key
+        image_paths = None
+        update_status(f"[{trace.trace_id}] 图像生成失败: {e}")
+        print(f"Error: {e}")
+    except Exception as e:
+        image_paths = None
+        update_status(f"[{trace.trace_id}] 图像生成失败: {e}")
+        print(f"Error: {e}")
+    finish_generation_job(job_id, job_key, trace, args, use_dr, on_result, image_paths)
+
+def finish_generation_job(job_id, job_key, trace, args, use_dr, on_result, image_paths):
+    if image_paths:
+        job_journal.append(job_key, "done", files=image_paths)
+    else:
+        job_journal.append(job_key, "failed")
+        trace.finish("failed")
+    sequence = args[0].get("SEQUENCE")
+    if image_paths or sequence:
+        run_on_ui_thread(deliver_job, job_key, image_paths or [], use_dr, sequence, trace)
+    if on_result:
+        try:
+            on_result(image_paths)
+        except Exception as e:
+            print(f"Error: {e}")
+    set_job_state(job_id, "done" if image_paths else "failed")
+
+# 远程生成：填写任务服务器时任务提交到局域网中的 stability_server，API Key 一栏填写服务器分配的访问令牌；
+# 否则勾选后台服务时交给本机常驻的 stability_daemon 进程，关闭窗口不会中断，下次打开脚本时取回结果。
+# 两者的客户端接口相同；后台服务不可用时在本进程的线程池中执行，任务服务器不可用时任务等待服务器恢复
+remote_client = None
+remote_client_target = None
+remote_jobs = {}  # job_key -> (job_id, trace, generate, args, use_dr, on_result)
+remote_jobs_lock = threading.Lock()
+# 提交请求在单独的线程中按顺序发出，服务慢或不可达时不阻塞界面
+remote_submit_executor = ThreadPoolExecutor(max_workers=1)
+
+def remote_target():
+    # 任务服务器地址、"daemon" 或 None（在本进程中生成）
+    server = itm["JobServer"].Text.strip()
+    if server:
+        return server
+    return "daemon" if itm["DaemonCheckBox"].Checked else None
+
+def connect_remote_async(on_connected=None):
+    # 第一次使用后台服务需要启动它，可能要几秒，在后台线程中连接，连上后回到 UI 线程
+    target = remote_target()
+    token = itm["ApiKey"].Text
+
+    def connect():
+        try:
+            if target == "daemon":
+                client = stability_daemon.connect_daemon()
+            else:
+                client = stability_server.connect_job_server(target, token)
+        except Exception as e:
+            print(f"Error connecting to {target}: {e}")
+            client = None
+        run_on_ui_thread(on_remote_connected, target, client, on_connected)
+
+    threading.Thread(target=connect, daemon=True).start()
+
+def on_remote_connected(target, client, on_connected=None):
+    global remote_client, remote_client_target
+    if client is None:
+        if target == "daemon":
+            update_status("后台服务不可用，在本窗口中生成.")
+        else:
+            update_status("任务服务器不可用，任务将等待服务器恢复.")
+    else:
+        if remote_client is not None:
+            # 切换到另一个服务：旧服务上未完成的任务之后重新提交到新服务
+            remote_client.close()
+            reclaim_remote_jobs("switched to another service")
+        remote_client = client
+        remote_client_target = target
+        update_status("已连接后台服务." if target == "daemon" else "已连接任务服务器.")
+    # 先认领上一次会话的任务，再开始接收结果
+    if on_connected:
+        on_connected()
+    if client is not None:
+        client.listen(on_remote_result, on_remote_disconnected)
+
+def on_remote_disconnected(error):
+    run_on_ui_thread(reclaim_remote_jobs, error)
+
+def reclaim_remote_jobs(error):
+    # 服务退出或断开时还没有结果的任务按离线处理，之后重新提交（已生成的图片会命中缓存）
+    global remote_client, remote_client_target
+    remote_client = None
+    remote_client_target = None
+    with remote_jobs_lock:
+        jobs = list(remote_jobs.items())
+        remote_jobs.clear()
+    print(f"Error: generation service disconnected: {error}")
+    update_status(f"生成服务已断开，{len(jobs)} 个任务将重新提交.")
+    for job_key, (job_id, trace, generate, args, use_dr, on_result) in jobs:
+        job_journal.append(job_key, "offline", error="generation service disconnected")
+        defer_job(job_key, generate, args, use_dr, on_result)
+        trace.finish("offline")
+        set_job_state(job_id, "offline")
+
+def track_remote_job(job_id, job_key, trace, generate, args, use_dr, on_result=None):
+    with remote_jobs_lock:
+        remote_jobs[job_key] = (job_id, trace, generate, args, use_dr, on_result)
+
+def submit_remote(job_id, job_key, trace, generate, args, use_dr, on_result, workers):
+    client, target = remote_client, remote_client_target
+    track_remote_job(job_id, job_key, trace, generate, args, use_dr, on_result)
+
+    def submit():
+        try:
+            client.submit(job_key, trace.trace_id, generate.__name__, args, workers)
+        except (OSError, EOFError, RuntimeError) as e:
+            print(f"Error submitting to {target}: {e}")
+            with remote_jobs_lock:
+                job = remote_jobs.pop(job_key, None)
+            # 服务断开时任务可能已经按离线处理
+            if job is not None:
+                run_on_ui_thread(submit_local, job_id, job_key, trace, generate, args, use_dr, on_result, workers, target)
+
+    remote_submit_executor.submit(submit)
+
+def on_remote_result(result):
+    # 在接收结果的后台线程中调用，之后的处理与线程池中的任务相同
+    job_key = result["job_key"]
+    with remote_jobs_lock:
+        job = remote_jobs.pop(job_key, None)
+    if job is None:
+        return
+    job_id, trace, generate, args, use_dr, on_result = job
+    for stage, seconds in result["stages"].items():
+        trace.add(stage, seconds)
+    trace.update(**result["fields"])
+    if result["state"] == "offline":
+        defer_offline_job(job_id, job_key, trace, generate, args, use_dr, on_result, result["error"])
+        return
+    if result["error"]:
+        update_status(f"[{trace.trace_id}] 图像生成失败: {result['error']}")
+        print(f"Error: {result['error']}")
+    finish_generation_job(job_id, job_key, trace, args, use_dr, on_result, result["files"])
+
+def on_remote_setting_changed(ev):
+    settings_autosaver.touch()
+    target = remote_target()
+    if target is not None and target != remote_client_target:
+        connect_remote_async()
+win.On.DaemonCheckBox.Clicked = on_remote_setting_changed
+win.On.JobServer.EditingFinished = on_remote_setting_changed
+
+def submit_generation(generate, args, use_dr, workers=1, on_result=None, job_key=None):
+    job_id = next(job_ids)
+    if job_key is None:
+        # API Key 不写入日志，恢复时使用当前配置中的 Key
+        job_key = uuid.uuid4().hex
+        settings = {key: value for key, value in args[0].items() if key != "API_KEY"}
+        job_journal.append(job_key, "queued", generate=generate.__name__, settings=settings, args=list(args[1:]), use_dr=use_dr)
+    else:
+        job_journal.append(job_key, "queued")
+    set_job_state(job_id, "queued")
+    trace = JobTrace(job=job_key)
+    target = remote_target()
+    if target is not None and target == remote_client_target:
+        submit_remote(job_id, job_key, trace, generate, args, use_dr, on_result, workers)
+        return
+    submit_local(job_id, job_key, trace, generate, args, use_dr, on_result, workers, target)
+
+def submit_local(job_id, job_key, trace, generate, args, use_dr, on_result, workers, target):
+    # 后台服务不可用时在本进程的线程池中执行
+    if target not in (None, "daemon"):
+        # 使用任务服务器时本机没有 API Key，服务器不可用时任务等它恢复后再提交
+        job_journal.append(job_key, "offline", error="job server unavailable")
+        defer_job(job_key, generate, args, use_dr, on_result)
+        trace.finish("offline")
+        set_job_state(job_id, "offline")
+        return
+    queue_job()
+    get_generation_executor(workers).submit(run_generation_job, job_id, job_key, trace, generate, args, use_dr, on_result)
+
+# 任务日志：每个任务的请求、状态和结果文件追加写入磁盘（每条记录 fsync），
+# 脚本崩溃或关闭后，下次启动时导入已完成但未导入的图片，未完成和离线的任务在 API 可用后重新提交
+JOURNAL_FILE = os.path.join(script_path, 'Stability_jobs.jsonl')
+JOB_FINISHED_EVENTS = {"imported", "failed"}
+OFFLINE_PROBE_INTERVAL = 30.0
+
+job_journal = JobJournal(JOURNAL_FILE)
+offline_jobs = []  # (job_key, generate, args, use_dr, on_result)
+offline_jobs_lock = threading.Lock()
+last_offline_probe = 0.0
+
+def defer_job(job_key, generate, args, use_dr, on_result=None):
+    with offline_jobs_lock:
+        offline_jobs.append((job_key, generate, args, use_dr, on_result))
+
+def probe_offline_jobs(api_key, workers):
+    # 由 PollTimer 调用：有离线任务时定期用第一个 Key 查询余额，查询成功说明 API 已恢复
+    global last_offline_probe
+    with offline_jobs_lock:
+        if not offline_jobs or time.monotonic() - last_offline_probe < OFFLINE_PROBE_INTERVAL:
+            return
+    last_offline_probe = time.monotonic()
+    target = remote_target()
+    if target not in (None, "daemon"):
+        # 任务服务器自己等待 API 恢复，这里只需要确认能连上服务器
+        if target == remote_client_target:
+            flush_offline_jobs(api_key, workers)
+        else:
+            connect_remote_async(functools.partial(flush_offline_jobs_if_connected, api_key, workers))
+        return
+    keys = parse_api_keys(api_key)
+    if not keys:
+        return
 
-    if response.status_code != 200:
-        raise Exception("Non-200 response: " + str(response.text))
+    def on_probe(credits, error):
+        if error is None:
+            run_on_ui_thread(flush_offline_jobs, api_key, workers)
 
-    payload = response.json()
-    credits = payload.get("credits", 0.0)
-    return round(credits, 1)
+    credit_tracker.refresh_async(keys[0], on_probe)
 
-def generate_image_v1(settings, engine_id):
-    update_status("图像生成中...")
+def flush_offline_jobs_if_connected(api_key, workers):
+    if remote_client is not None:
+        flush_offline_jobs(api_key, workers)
 
-    url = f"https://api.stability.ai/v1/generation/{engine_id}/text-to-image"
-    count = 0
-    file_exists = False
-    output_file = None
+def flush_offline_jobs(api_key, workers):
+    with offline_jobs_lock:
+        jobs = list(offline_jobs)
+        offline_jobs.clear()
+    if not jobs:
+        return
+    update_status(f"API 已恢复，重新提交 {len(jobs)} 个任务.")
+    for job_key, generate, args, use_dr, on_result in jobs:
+        args[0]["API_KEY"] = api_key
+        submit_generation(generate, args, use_dr, workers, on_result, job_key)
+
+def recover_jobs(api_key):
+    # 启动时回放日志：已完成的任务补做导入，其余任务等 API 可用后重新提交
+    generators = {generate.__name__: generate for generate in (generate_image_v1, generate_image_v2)}
+    pending = collections.OrderedDict()
+    for job_key, record in job_journal.replay().items():
+        if record.get("event") in JOB_FINISHED_EVENTS:
+            continue
+        if record.get("event") == "done" or (record.get("generate") in generators and "settings" in record):
+            pending[job_key] = record
+    job_journal.compact(pending)
+    # 上一次会话交给后台服务的任务如果仍在服务中（执行中或结果未取回），直接认领，不再重新提交
+    attached_jobs = {}
+    if remote_client is not None:
+        try:
+            attached_jobs = remote_client.attach({job_key: record["settings"].get("OUTPUT_DIRECTORY") for job_key, record in pending.items()
+                                                  if record["event"] != "done"})
+        except (OSError, EOFError, RuntimeError) as e:
+            print(f"Error: {e}")
+    resumed = attached = 0
+    for job_key, record in pending.items():
+        use_dr = record.get("use_dr", True)
+        if record["event"] == "done":
+            image_paths = [path for path in record.get("files", []) if os.path.exists(path)]
+            if not image_paths:
+                # 图片已被删除，没有可导入的内容，结束该任务，不再每次启动都回放
+                job_journal.append(job_key, "failed", error="output files missing")
+                continue
+            print(f"Importing images of interrupted job {job_key}: {image_paths}")
+            deliver_job(job_key, image_paths, use_dr)
+            continue
+        # 帧序列和对比图属于上一次会话，恢复的任务单独导入
+        settings = dict(record["settings"], API_KEY=api_key)
+        settings.pop("SEQUENCE", None)
+        args = (settings,) + tuple(record.get("args", []))
+        if job_key in attached_jobs:
+            job_id = next(job_ids)
+            trace = JobTrace(job=job_key)
+            trace.trace_id = attached_jobs[job_key]
+            track_remote_job(job_id, job_key, trace, generators[record["generate"]], args, use_dr)
+            set_job_state(job_id, "running")
+            attached += 1
+            continue
+        defer_job(job_key, generators[record["generate"]], args, use_dr)
+        resumed += 1
+    if attached:
+        update_status(f"{attached} 个任务仍在后台服务中执行.")
+    if resumed:
+        update_status(f"已恢复 {resumed} 个未完成的任务，等待 API 可用.")
+
+# 参数扫描：全部完成后在本地拼接带标注的对比图
+class ContactSheet:
+    def __init__(self, labels, output_directory, use_dr):
+        self.labels = labels
+        self.output_directory = output_directory
+        self.use_dr = use_dr
+        self.thumbnails = [None] * len(labels)
+        self.remaining = len(labels)
+        self.lock = threading.Lock()
+
+    def add(self, index, image_paths):
+        # 在工作线程中生成缩略图，最后一个结果到达时拼接并导入
+        if image_paths:
+            try:
+                self.thumbnails[index] = make_thumbnail(image_paths[0])
+            except OSError as e:
+                print(f"Error reading {image_paths[0]}: {e}")
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining:
+                return
+        if not any(self.thumbnails):
+            return
+        output_file = allocate_output_file(self.output_directory, "contact-sheet", "sweep", "png")
+        try:
+            compose_contact_sheet(self.thumbnails, self.labels, output_file)
+        except (OSError, ValueError):
+            release_output_file(output_file)
+            raise
+        print(f"Contact sheet saved to {output_file}")
+        run_on_ui_thread(deliver_images, [output_file], self.use_dr)
+
+def prepare_sweep(jobs, text, fields, prompt_key, settings, use_dr):
+    try:
+        swept = expand_sweep(jobs, parse_sweep(text, fields), prompt_key)
+    except ValueError as e:
+        show_warning_message(f'参数扫描格式错误: {e}')
+        return None, None
+    if len(swept) > MAX_SWEEP_JOBS:
+        show_warning_message(f'参数组合过多: {len(swept)} (最多 {MAX_SWEEP_JOBS}).')
+        return None, None
+    if not contact_sheet_supported():
+        print("Pillow is not installed, the contact sheet will be skipped.")
+        return [job for job, _ in swept], None
+    sheet = ContactSheet([label for _, label in swept], settings["OUTPUT_DIRECTORY"], use_dr)
+    return [job for job, _ in swept], sheet
+
+# 时间线放置：每次导入后用一次 AppendToTimeline 把图片依次放到播放头位置。
+# 只放置新生成的图片，历史中重新导入、恢复的任务和对比图只进媒体池
+timeline_placer = TimelinePlacer()
+
+def on_media_imported(media_pool, items):
+    paths = [os.path.normpath(item.GetClipProperty("File Path") or "") for item in items]
+    items = [item for item, path in zip(items, paths) if path in timeline_paths]
+    timeline_paths.difference_update(paths)
+    if not items or not itm["TimelineCheckBox"].Checked:
+        return
+    timeline = media_pool_importer.project_manager.GetCurrentProject().GetCurrentTimeline()
+    if timeline is None:
+        print("No current timeline, skipping timeline placement.")
+        return
+    track = parse_count(itm["TimelineTrack"].Text)
+    duration = parse_count(itm["StillDuration"].Text, 120)
+    timeline_placer.append(timeline, media_pool, items, track, duration)
 
-    while True:
-        count += 1
-        output_directory = settings["OUTPUT_DIRECTORY"]
-        output_file = os.path.join(output_directory, f"image{settings['SEED_V1']}{count}a.png")
-        if os.path.exists(output_file):
-            file_exists = True
-        else:
-            file_exists = False
+media_pool_importer.add_listener(on_media_imported)
 
-        if not file_exists:
-            break
+def on_media_recorded(media_pool, items):
+    # 把媒体池条目 id 记入历史，便于之后定位
+    try:
+        generation_history.set_media_pool_items([(item.GetUniqueId(), item.GetClipProperty("File Path")) for item in items])
+    except sqlite3.Error as e:
+        print(f"Error writing history: {e}")
 
-    data = {
-        "text_prompts": [{"text": settings["PROMPT_V1"]}],
-        "cfg_scale": settings["CFG_SCALE"],
-        "height": settings["HEIGHT"],
-        "width": settings["WIDTH"],
-        "samples": settings["SAMPLES"],
-        "steps": settings["STEPS"],
-        "seed": settings["SEED_V1"],
-        "sampler": settings["SAMPLER"]
-    }
-    if get_style_preset_en(settings.get("STYLE_PRESET_V1"))!="Default":
-        data["style_preset"] = get_style_preset_en(settings["STYLE_PRESET_V1"])
+media_pool_importer.add_listener(on_media_recorded)
 
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "image/png",
-        "Authorization": f"Bearer {settings['API_KEY']}"
-    }
+def on_poll_timer_timeout(ev):
+    while True:
+        try:
+            func, args = ui_queue.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            func(*args)
+        except Exception as e:
+            print(f"Error: {e}")
+    try:
+        media_pool_importer.flush()
+        fusion_loader_batcher.flush()
+        settings_autosaver.poll(collect_settings)
+        probe_offline_jobs(itm["ApiKey"].Text, parse_count(itm["Concurrency"].Text, 2, MAX_CONCURRENCY))
+    except Exception as e:
+        print(f"Error: {e}")
 
-    print("Sending request to URL:", url)
-    print("Request data:", json.dumps(data, indent=2))
-    
-    response = requests.post(url, headers=headers, json=data)
-
-    if response.status_code == 200:
-        with open(output_file, 'wb') as file:
-            file.write(response.content)
-        update_status("图像生成成功.")
-        print(f"Success: Image saved to {output_file}")
-        return output_file
-    else:
-        error_message = response.json()
-        update_status(f"图像生成失败: {response.status_code}")
-        print(f"Error: {error_message}")
-        return None
+poll_timer = ui.Timer({"ID": 'PollTimer', "Interval": 100})
+dispatcher.On.PollTimer.Timeout = on_poll_timer_timeout
 
-def generate_image_v2(settings):
-    update_status("图像生成中...")
-    count = 0
-    file_exists = False
-    output_file = None
+# 运行指标面板：由单独的低频定时器读取汇总快照，只在配置页可见时刷新，并定期导出 Prometheus 文本文件
+METRICS_REFRESH_INTERVAL = 1000
+METRICS_EXPORT_INTERVAL = 15.0
+last_metrics_export = 0.0
 
-    while True:
-        count += 1
-        output_directory = settings["OUTPUT_DIRECTORY"]
-        output_file = os.path.join(output_directory, f"image{settings['SEED_V2']}{count}a.{settings['OUTPUT_FORMAT']}")
-        if os.path.exists(output_file):
-            file_exists = True
-        else:
-            file_exists = False
+def format_latency(seconds):
+    return "-" if seconds is None else f"{seconds:.1f}s"
 
-        if not file_exists:
-            break
-    #print(output_file)
-    url = ""
-    data = {
-        "prompt": settings["PROMPT_V2"],
-        "negative_prompt": settings["NEGATIVE_PROMPT"],
-        "seed": settings["SEED_V2"],
-        "aspect_ratio": settings["ASPECT_RATIO"],
-        "output_format": settings["OUTPUT_FORMAT"],
-    }
+metrics_fetch_running = False
 
-    if settings["MODEL_V2"] == "ultra":
-        url = "https://api.stability.ai/v2beta/stable-image/generate/ultra"
+def update_metrics_panel():
+    # 使用后台服务或任务服务器时生成在远程进行，显示远程的指标；在后台线程中获取，服务慢或不可达时不阻塞界面
+    global metrics_fetch_running
+    client = remote_client
+    if client is None:
+        show_metrics_snapshot(metrics.snapshot(), None)
+        return
+    if metrics_fetch_running:
+        return
+    metrics_fetch_running = True
 
-    elif settings["MODEL_V2"] == "core":
-        url = "https://api.stability.ai/v2beta/stable-image/generate/core"
-        if get_style_preset_en(settings["STYLE_PRESET"])!="Default":
-            data["style_preset"] = get_style_preset_en(settings["STYLE_PRESET"])
+    def fetch():
+        try:
+            run_on_ui_thread(show_metrics_snapshot, client.metrics(), None)
+        except (OSError, EOFError, RuntimeError, ValueError) as e:
+            run_on_ui_thread(show_metrics_snapshot, None, e)
 
-    elif settings["MODEL_V2"] in ["sd3-large", "sd3-large-turbo","sd3-medium"]:
-        url = "https://api.stability.ai/v2beta/stable-image/generate/sd3"
-        data["mode"] = "text-to-image"
-        data["model"] = settings["MODEL_V2"]
-    else:
-        update_status("Invalid model specified.")
-        return None
+    threading.Thread(target=fetch, daemon=True).start()
 
-    headers = {
-        "Authorization": f"Bearer {settings['API_KEY']}",
-        "Accept": "image/*"
-    }
+def show_metrics_snapshot(snapshot, error):
+    global metrics_fetch_running
+    metrics_fetch_running = False
+    if error is not None:
+        itm["MetricsLabel"].Text = f"无法获取指标：{error}"
+        return
+    itm["MetricsLabel"].Text = (
+        f"排队 {snapshot.get('queued', 0)}  |  生成中 {snapshot.get('in_flight', 0)}  |  完成 {snapshot.get('generations', 0)}  |  失败 {snapshot.get('failed', 0)}\n"
+        f"图像/分钟 {snapshot['images_per_min']:.1f}  |  p50 {format_latency(snapshot['p50'])}  |  p95 {format_latency(snapshot['p95'])}  |  积分/分钟 {snapshot['credits_per_min']:.1f}"
+    )
 
-    print("Sending request to URL:", url)
-    print("Request data:", data)
-
-    response = requests.post(url, headers=headers, files={"none": ""}, data=data)
-    if response.status_code == 200:
-        credits = get_remaining_credits(settings['API_KEY'])
-        with open(output_file, 'wb') as file:
-            file.write(response.content)
-        update_status("图像生成成功.")
-        print(f"Success: Image saved to {output_file}")
-        return output_file
-    else:
-        error_message = response.json()
-        update_status(f"图像生成失败: {response.status_code}")
-        print(f"Error: {error_message}")
-        return None
+def on_metrics_timer_timeout(ev):
+    global last_metrics_export
+    try:
+        if itm["MyStack"].CurrentIndex == 2:
+            update_metrics_panel()
+        if time.monotonic() - last_metrics_export >= METRICS_EXPORT_INTERVAL:
+            last_metrics_export = time.monotonic()
+            metrics.write_prometheus(METRICS_FILE)
+    except Exception as e:
+        print(f"Error: {e}")
 
+metrics_timer = ui.Timer({"ID": 'MetricsTimer', "Interval": METRICS_REFRESH_INTERVAL})
+dispatcher.On.MetricsTimer.Timeout = on_metrics_timer_timeout
 
 def on_generate_button_clicked(ev):
     if itm["Path"].Text == '':
         show_warning_message('Please go to Configuration to select the image save path.')
         return
-    if itm["ApiKey"].Text == '':
+    if itm["ApiKey"].Text == '' and not itm["JobServer"].Text.strip():
         show_warning_message('Please go to Configuration to enter the API Key.')
         return
+    workers = parse_count(itm["Concurrency"].Text, 2, MAX_CONCURRENCY)
 
     if itm["MyTabs"].CurrentIndex == 1:
         if itm["RandomSeedV2"].Checked:
@@ -844,7 +1532,7 @@ def on_generate_button_clicked(ev):
             "API_KEY": itm["ApiKey"].Text,
             "PROMPT_V2": itm["PromptTxtV2"].PlainText,
             "NEGATIVE_PROMPT": itm["NegativePromptTxt"].PlainText,
-            "STYLE_PRESET": itm["StyleCombo"].CurrentText,
+            "STYLE_PRESET": get_style_preset_en(itm["StyleCombo"].CurrentText),
             "ASPECT_RATIO": itm["AspectRatioCombo"].CurrentText,
             "OUTPUT_FORMAT": itm["OutputFormatCombo"].CurrentText,
             "MODEL_V2": model_id,
@@ -852,13 +1540,21 @@ def on_generate_button_clicked(ev):
             "OUTPUT_DIRECTORY": itm["Path"].Text,
         }
 
-        # 执行图片生成和加载操作
-        image_path = generate_image_v2(settings)
-        if image_path:
-            if itm["DRCheckBox"].Checked:
-                add_to_media_pool(image_path)
-            else:
-                load_image_in_fusion(image_path)
+        # 后台执行图片生成，每张完成后立即导入
+        jobs = [settings]
+        if itm["BatchV2"].Checked:
+            jobs = expand_batch(settings, "PROMPT_V2", "SEED_V2", parse_count(itm["BatchCountV2"].Text), itm["RandomSeedV2"].Checked)
+        sheet = None
+        if itm["SweepV2"].Checked:
+            jobs, sheet = prepare_sweep(jobs, itm["SweepGridV2"].Text, sweep_fields_v2, "PROMPT_V2", settings, itm["DRCheckBox"].Checked)
+            if jobs is None:
+                return
+        if not check_credits(settings["API_KEY"], model_id, len(jobs)):
+            return
+        assign_sequence(jobs, model_id, itm["DRCheckBox"].Checked)
+        for index, job in enumerate(jobs):
+            on_result = functools.partial(sheet.add, index) if sheet else None
+            submit_generation(generate_image_v2, (job,), itm["DRCheckBox"].Checked, workers, on_result)
     elif itm["MyTabs"].CurrentIndex == 0:
         if itm["RandomSeed"].Checked:
             newseed = random.randint(0, 4294967295)
@@ -874,24 +1570,33 @@ def on_generate_button_clicked(ev):
             "CFG_SCALE": float(itm["CfgScale"].Text),
             "HEIGHT": int(itm["Height"].Text),
             "WIDTH": int(itm["Width"].Text),
-            "STYLE_PRESET_V1": itm["StyleComboV1"].CurrentText,
-            "SAMPLES": int(itm["Samples"].Text),
+            "STYLE_PRESET_V1": get_style_preset_en(itm["StyleComboV1"].CurrentText),
+            "SAMPLES": parse_count(itm["Samples"].Text, 1, MAX_SAMPLES),
             "STEPS": int(itm["Steps"].Text),
             "SEED_V1": newseed,
             "OUTPUT_DIRECTORY": itm["Path"].Text,
         }
 
-        # 执行图片生成和加载操作
-        image_path = generate_image_v1(settings, engine_id)
-        if image_path:
-            if itm["DRCheckBox"].Checked:
-                add_to_media_pool(image_path)
-            else:
-                load_image_in_fusion(image_path)
+        # 后台执行图片生成，每张完成后立即导入
+        jobs = [settings]
+        if itm["BatchV1"].Checked:
+            jobs = expand_batch(settings, "PROMPT_V1", "SEED_V1", parse_count(itm["BatchCountV1"].Text), itm["RandomSeed"].Checked)
+        sheet = None
+        if itm["SweepV1"].Checked:
+            jobs, sheet = prepare_sweep(jobs, itm["SweepGridV1"].Text, sweep_fields_v1, "PROMPT_V1", settings, itm["DRCheckBox"].Checked)
+            if jobs is None:
+                return
+        if not check_credits(settings["API_KEY"], engine_id, len(jobs) * settings["SAMPLES"]):
+            return
+        if settings["SAMPLES"] == 1:
+            assign_sequence(jobs, engine_id, itm["DRCheckBox"].Checked)
+        for index, job in enumerate(jobs):
+            on_result = functools.partial(sheet.add, index) if sheet else None
+            submit_generation(generate_image_v1, (job, engine_id), itm["DRCheckBox"].Checked, workers, on_result)
 win.On.GenerateButton.Clicked = on_generate_button_clicked
 
-def close_and_save(settings_file):
-    settings = {
+def collect_settings():
+    return {
         "USE_DR": itm["DRCheckBox"].Checked,
         "USE_FU": itm["FUCheckBox"].Checked,
         "API_KEY": itm["ApiKey"].Text,
@@ -899,25 +1604,40 @@ def close_and_save(settings_file):
         "NEGATIVE_PROMPT": itm["NegativePromptTxt"].PlainText,
         "STYLE_PRESET": itm["StyleCombo"].CurrentIndex,
         "STYLE_PRESET_V1": itm["StyleComboV1"].CurrentIndex,
-        "SEED_V2": int(itm["SeedV2"].Text),
+        "SEED_V2": itm["SeedV2"].Text,
         "ASPECT_RATIO": itm["AspectRatioCombo"].CurrentIndex,
         "OUTPUT_FORMAT": itm["OutputFormatCombo"].CurrentIndex,
         "MODEL_V2": itm["ModelComboV2"].CurrentIndex,
         "USE_RANDOM_SEED_V2": itm["RandomSeedV2"].Checked,
         "OUTPUT_DIRECTORY": itm["Path"].Text,
         "PROMPT_V1": itm["PromptTxt"].PlainText,
-        "SEED_V1": int(itm["Seed"].Text),
-        "CFG_SCALE": float(itm["CfgScale"].Text),
-        "HEIGHT": int(itm["Height"].Text),
-        "WIDTH": int(itm["Width"].Text),
+        "SEED_V1": itm["Seed"].Text,
+        "CFG_SCALE": itm["CfgScale"].Text,
+        "HEIGHT": itm["Height"].Text,
+        "WIDTH": itm["Width"].Text,
         "SAMPLER": itm["SamplerCombo"].CurrentIndex,
         "MODEL_V1": itm["ModelCombo"].CurrentIndex,
-        "SAMPLES": int(itm["Samples"].Text),
-        "STEPS": int(itm["Steps"].Text),
-        "USE_RANDOM_SEED_V1": itm["RandomSeed"].Checked
+        "SAMPLES": itm["Samples"].Text,
+        "STEPS": itm["Steps"].Text,
+        "USE_RANDOM_SEED_V1": itm["RandomSeed"].Checked,
+        "BATCH_V1": itm["BatchV1"].Checked,
+        "BATCH_V2": itm["BatchV2"].Checked,
+        "BATCH_COUNT_V1": itm["BatchCountV1"].Text,
+        "BATCH_COUNT_V2": itm["BatchCountV2"].Text,
+        "CONCURRENCY": itm["Concurrency"].Text,
+        "USE_DAEMON": itm["DaemonCheckBox"].Checked,
+        "JOB_SERVER": itm["JobServer"].Text,
+        "SWEEP_V1": itm["SweepV1"].Checked,
+        "SWEEP_V2": itm["SweepV2"].Checked,
+        "SWEEP_GRID_V1": itm["SweepGridV1"].Text,
+        "SWEEP_GRID_V2": itm["SweepGridV2"].Text,
+        "APPEND_TO_TIMELINE": itm["TimelineCheckBox"].Checked,
+        "TIMELINE_TRACK": itm["TimelineTrack"].Text,
+        "STILL_DURATION": itm["StillDuration"].Text
     }
 
-    save_settings(settings, settings_file)
+def close_and_save(settings_file):
+    settings_autosaver.save(collect_settings())
 
 def on_help_button_clicked(ev):
     helpmsg1 = ''' 
@@ -939,12 +1659,16 @@ def on_help_button_clicked(ev):
         <li>No dimension can be less than 320 pixels</li>
         <li>No dimension can be greater than 1536 pixels</li>
     </ul>
+    <h2>Sweep</h2>
+    <p>Generates every combination of the listed values and imports a labelled contact sheet, e.g. <code>seed=1,2; cfg=5,7; steps=20,40; sampler=*</code>. Use * for all samplers. The contact sheet needs Pillow.</p>
     '''
     helpmsg2 = ''' 
     <h2>Negative_Prompt</h2>
     <p>This parameter does not work with SD3-Turbo model.</p>
     <h2>Style_Preset</h2>
     <p>This parameter is applicable exclusively to the Core model.</p>
+    <h2>Sweep</h2>
+    <p>Generates every combination of the listed values and imports a labelled contact sheet, e.g. <code>seed=1,2,3; style=*</code>. Use * for all style presets. The contact sheet needs Pillow.</p>
     '''
     
     if itm["MyTabs"].CurrentIndex == 1:
@@ -994,6 +1718,10 @@ def on_reset_button_clicked(ev):
         itm["OutputFormatCombo"].CurrentIndex = default_settings["OUTPUT_FORMAT"]
         itm["AspectRatioCombo"].CurrentIndex = default_settings["ASPECT_RATIO"]
         itm["RandomSeedV2"].Checked = default_settings["USE_RANDOM_SEED_V2"]
+        itm["BatchV2"].Checked = default_settings["BATCH_V2"]
+        itm["BatchCountV2"].Text = default_settings["BATCH_COUNT_V2"]
+        itm["SweepV2"].Checked = default_settings["SWEEP_V2"]
+        itm["SweepGridV2"].Text = default_settings["SWEEP_GRID_V2"]
 
     elif itm["MyTabs"].CurrentIndex == 0:
         itm["PromptTxt"].PlainText = default_settings["PROMPT_V1"]
@@ -1007,8 +1735,13 @@ def on_reset_button_clicked(ev):
         itm["Samples"].Text = str(default_settings["SAMPLES"])
         itm["Steps"].Text = str(default_settings["STEPS"])
         itm["RandomSeed"].Checked = default_settings["USE_RANDOM_SEED_V1"]
+        itm["BatchV1"].Checked = default_settings["BATCH_V1"]
+        itm["BatchCountV1"].Text = default_settings["BATCH_COUNT_V1"]
+        itm["SweepV1"].Checked = default_settings["SWEEP_V1"]
+        itm["SweepGridV1"].Text = default_settings["SWEEP_GRID_V1"]
 
     update_status(" ")
+    settings_autosaver.touch()
 win.On.ResetButton.Clicked = on_reset_button_clicked
 
 
@@ -1022,22 +1755,142 @@ def on_browse_button_clicked(ev):
 win.On.Browse.Clicked = on_browse_button_clicked
 
 
-def on_balance_button_clicked(ev):
-    try:
-        credits = get_remaining_credits(itm["ApiKey"].Text)
-        itm["BalanceLabel"].Text = f"剩余积分: {credits}"
-        print(f"Credits: {credits}")
-    except Exception as e:
+def show_balances(results):
+    credits = [value for value in results.values() if not isinstance(value, Exception)]
+    for key, value in results.items():
+        print(f"{mask_api_key(key)}: {value}")
+    if not credits:
         itm["BalanceLabel"].Text = f"Invalid API key"
-        print(f"发生错误: {e}")
+    elif len(results) == 1:
+        itm["BalanceLabel"].Text = f"剩余积分: {credits[0]}"
+    else:
+        itm["BalanceLabel"].Text = f"剩余积分: {round(sum(credits), 1)} ({len(credits)}/{len(results)} 个 Key)"
+
+def show_server_balance(credits, error):
+    if error is not None:
+        itm["BalanceLabel"].Text = "任务服务器未连接"
+        print(f"Error: {error}")
+    else:
+        itm["BalanceLabel"].Text = f"剩余积分: {credits}"
+
+def on_balance_button_clicked(ev):
+    # 使用任务服务器时显示服务器上所有 Key 的余额合计；否则在后台并发查询所有 Key 的余额，结果回到 UI 线程显示
+    target = remote_target()
+    if target not in (None, "daemon"):
+        client = remote_client if target == remote_client_target else None
+
+        def fetch():
+            try:
+                if client is None:
+                    raise ConnectionError(f"not connected to {target}")
+                run_on_ui_thread(show_server_balance, client.balance(), None)
+            except (OSError, RuntimeError) as e:
+                run_on_ui_thread(show_server_balance, None, e)
+
+        threading.Thread(target=fetch, daemon=True).start()
+        return
+    get_key_pool(itm["ApiKey"].Text).refresh_async(lambda results: run_on_ui_thread(show_balances, results))
 win.On.Balance.Clicked = on_balance_button_clicked
 
+# 历史页：键集分页只记录每页的起始游标，不计算总行数
+history_cursors = [None]
+history_next_cursor = None
+
+def show_history_page():
+    global history_next_cursor
+    try:
+        rows = generation_history.search(itm["HistorySearch"].Text, history_cursors[-1], HISTORY_PAGE_SIZE + 1)
+    except sqlite3.Error as e:
+        print(f"Error querying history: {e}")
+        rows = []
+    has_next = len(rows) > HISTORY_PAGE_SIZE
+    rows = rows[:HISTORY_PAGE_SIZE]
+    tree = itm["HistoryTree"]
+    tree.UpdatesEnabled = False
+    tree.Clear()
+    for row_id, created, model, seed, prompt, output_path in rows:
+        item = tree.NewItem()
+        item.Text[0] = time.strftime("%Y-%m-%d %H:%M", time.localtime(created))
+        item.Text[1] = str(model)
+        item.Text[2] = str(seed)
+        item.Text[3] = prompt or ''
+        item.Text[4] = output_path or ''
+        tree.AddTopLevelItem(item)
+    tree.UpdatesEnabled = True
+    history_next_cursor = rows[-1][0] if has_next else None
+    itm["HistoryPrev"].Enabled = len(history_cursors) > 1
+    itm["HistoryNext"].Enabled = has_next
+    itm["HistoryPageLabel"].Text = f"第 {len(history_cursors)} 页"
+
+def on_history_search_clicked(ev):
+    del history_cursors[1:]
+    show_history_page()
+win.On.HistorySearchButton.Clicked = on_history_search_clicked
+win.On.HistorySearch.ReturnPressed = on_history_search_clicked
+
+def on_history_next_clicked(ev):
+    if history_next_cursor is not None:
+        history_cursors.append(history_next_cursor)
+        show_history_page()
+win.On.HistoryNext.Clicked = on_history_next_clicked
+
+def on_history_prev_clicked(ev):
+    if len(history_cursors) > 1:
+        history_cursors.pop()
+        show_history_page()
+win.On.HistoryPrev.Clicked = on_history_prev_clicked
+
+def on_history_tree_item_double_clicked(ev):
+    # 双击重新导入这张图片
+    output_path = ev["item"].Text[4]
+    if os.path.exists(output_path):
+        deliver_images([output_path], itm["DRCheckBox"].Checked)
+    else:
+        update_status(f"文件不存在: {output_path}")
+win.On.HistoryTree.ItemDoubleClicked = on_history_tree_item_double_clicked
+
 def on_close(ev):
     close_and_save(settings_file)
+    poll_timer.Stop()
+    metrics_timer.Stop()
+    on_poll_timer_timeout(None)
+    try:
+        media_pool_importer.flush(force=True)
+        fusion_loader_batcher.flush(force=True)
+    except Exception as e:
+        print(f"Error: {e}")
+    if generation_executor is not None:
+        generation_executor.shutdown(wait=False)
+    remote_submit_executor.shutdown(wait=False)
+    if remote_client is not None:
+        # 后台服务中的任务继续执行，结果留到下次打开脚本时取回；还没提交的任务留在日志中，下次启动时恢复
+        remote_client.close()
+    close_http_session()
+    generation_history.close()
+    metrics.write_prometheus(METRICS_FILE)
     dispatcher.ExitLoop()
 win.On.MyWin.Close = on_close
 
+def finish_startup():
+    # 第一次 PollTimer 时执行：窗口已经显示，再回放任务日志；使用后台服务或任务服务器时先连接
+    mark_startup("event loop")
+    if remote_target() is not None:
+        connect_remote_async(finish_recovery)
+    else:
+        finish_recovery()
+
+def finish_recovery():
+    recover_jobs(itm["ApiKey"].Text)
+    mark_startup("recover jobs")
+    print_startup_timing()
+
+mark_startup("widgets")
+
 # 显示窗口
 win.Show()
+mark_startup("show")
+run_on_ui_thread(finish_startup)
+poll_timer.Start()
+metrics_timer.Start()
 dispatcher.RunLoop()
 win.Hide()
@@ -0,0 +1,202 @@
+# 吞吐量和延迟基准测试：用引擎的生成路径（缓存查询、HTTP、重试、写文件、历史记录）对本地替身服务器批量生成，
+# 按并发数报告 图片/分钟、p50/p95/p99 延迟和峰值内存
+#     python benchmark.py -c 1,2,4,8 -n 32 --latency 1 --payload-bytes 1500000
+#     python benchmark.py --api-host http://127.0.0.1:8600 -m stable-diffusion-xl-1024-v1-0 --samples 4
+# 不指定 --api-host 时自动启动 mock_stability_server.py；每个并发数在独立子进程中运行，峰值内存互不影响
+import argparse
+import contextlib
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows 上不报告峰值内存
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+MOCK_SERVER = os.path.join(BENCHMARK_DIR, "mock_stability_server.py")
+MOCK_OPTIONS = ("latency", "jitter", "payload_bytes", "image_size", "error_rate", "rate_limit")
+
+def percentile(values, fraction):
+    # 最近秩法，样本少时不插值
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def mean_stages(trace_file):
+    # 各阶段的平均耗时（秒），来自引擎写入的追踪日志
+    totals = {}
+    count = 0
+    try:
+        with open(trace_file, 'r', encoding='utf-8') as file:
+            for line in file:
+                count += 1
+                for stage, seconds in json.loads(line).get("stages", {}).items():
+                    totals[stage] = totals.get(stage, 0.0) + seconds
+    except OSError:
+        return {}
+    return {stage: round(seconds / count, 4) for stage, seconds in totals.items()}
+
+def start_mock_server(args):
+    command = [sys.executable, MOCK_SERVER, "--port", "0"]
+    for option in MOCK_OPTIONS:
+        command += [f"--{option.replace('_', '-')}", str(getattr(args, option))]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    host = process.stdout.readline().strip()
+    if not host:
+        process.kill()
+        raise RuntimeError("mock_stability_server.py did not start")
+    return process, host
+
+def engine_job_options(args, output):
+    # build_cli_jobs 需要的命令行参数，固定种子为 0 让每个任务使用不同的随机种子，避免命中生成缓存
+    return argparse.Namespace(
+        api_key=args.api_key, model=args.model, seed=0, count=args.jobs, output=output,
+        negative_prompt='', style_preset="Default", aspect_ratio="1:1", output_format="png",
+        width=512, height=512, cfg_scale=7.0, steps=30, sampler="DDIM", samples=args.samples,
+    )
+
+def run_level(args, concurrency):
+    # 在当前进程中跑一个并发数；缓存和历史记录放到临时目录，不影响正式数据
+    sys.path.insert(0, BENCHMARK_DIR)
+    import stability_engine as engine
+
+    engine.API_HOST = args.api_host.rstrip("/")
+    engine.set_status_handler(lambda message: None)
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def timed(generate):
+        def run(*job_args):
+            started = time.perf_counter()
+            try:
+                return generate(*job_args)
+            finally:
+                with latencies_lock:
+                    latencies.append(time.perf_counter() - started)
+        return run
+
+    with tempfile.TemporaryDirectory(prefix="stability-bench-") as work_dir:
+        engine.generation_cache = engine.GenerationCache(os.path.join(work_dir, "cache"))
+        engine.generation_history = engine.GenerationHistory(os.path.join(work_dir, "history.db"))
+        engine.trace_log = engine.TraceLog(os.path.join(work_dir, "trace.jsonl"))
+        output = os.path.join(work_dir, "output")
+        os.makedirs(output)
+        jobs = engine.build_cli_jobs(engine_job_options(args, output), ["benchmark prompt"])
+        jobs = [(timed(generate), job_args) for generate, job_args in jobs]
+        images = failed = 0
+        output_bytes = 0
+        started = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            try:
+                for _, paths in engine.run_jobs(jobs, concurrency):
+                    if not paths:
+                        failed += 1
+                        continue
+                    images += len(paths)
+                    output_bytes += sum(os.path.getsize(path) for path in paths)
+            finally:
+                engine.close_http_session()
+                engine.generation_history.close()
+        elapsed = time.perf_counter() - started
+        stages = mean_stages(engine.trace_log.path)
+
+    return {
+        "concurrency": concurrency,
+        "jobs": len(jobs),
+        "images": images,
+        "failed": failed,
+        "seconds": round(elapsed, 3),
+        "images_per_min": round(images / elapsed * 60, 1) if elapsed else None,
+        "mb_per_s": round(output_bytes / elapsed / (1024 * 1024), 2) if elapsed else None,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": stages,
+    }
+
+def run_level_isolated(args, concurrency):
+    command = [sys.executable, os.path.abspath(__file__), "--level", str(concurrency), "--api-host", args.api_host,
+               "--api-key", args.api_key, "-m", args.model, "-n", str(args.jobs), "--samples", str(args.samples)]
+    result = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"benchmark at concurrency {concurrency} exited with {result.returncode}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def format_seconds(value):
+    return "-" if value is None else f"{value:.2f}s"
+
+def print_table(results):
+    print(f"{'conc':>4} {'jobs':>5} {'images':>6} {'failed':>6} {'img/min':>8} {'MB/s':>6} {'p50':>7} {'p95':>7} {'p99':>7} {'peak RSS':>9}")
+    for row in results:
+        rss = "-" if row["peak_rss_mb"] is None else f"{row['peak_rss_mb']:.0f} MB"
+        print(f"{row['concurrency']:>4} {row['jobs']:>5} {row['images']:>6} {row['failed']:>6} {row['images_per_min']:>8} {row['mb_per_s']:>6} "
+              f"{format_seconds(row['p50']):>7} {format_seconds(row['p95']):>7} {format_seconds(row['p99']):>7} {rss:>9}")
+    print("mean stage times per job:")
+    for row in results:
+        stages = ", ".join(f"{stage} {seconds * 1000:.0f} ms" for stage, seconds in sorted(row["stages"].items()))
+        print(f"{row['concurrency']:>4}  {stages}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="benchmark", description="Measure generation throughput and latency against a local Stability API stand-in.")
+    parser.add_argument("-c", "--concurrency", default="1,2,4,8", help="comma separated concurrency levels")
+    parser.add_argument("-n", "--jobs", type=int, default=32, help="generation requests per concurrency level")
+    parser.add_argument("-m", "--model", default="core", help="V2 model or V1 engine id")
+    parser.add_argument("--samples", type=int, default=1, help="V1 engines only, images per request")
+    parser.add_argument("--api-host", help="benchmark an already running server instead of starting the mock")
+    parser.add_argument("--api-key", default="benchmark")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--in-process", action="store_true", help="run all levels in this process (peak RSS becomes cumulative)")
+    parser.add_argument("--level", type=int, help=argparse.SUPPRESS)  # 子进程：只跑一个并发数，输出 JSON
+    mock = parser.add_argument_group("mock server", "used when --api-host is not given")
+    mock.add_argument("--latency", type=float, default=0.5)
+    mock.add_argument("--jitter", type=float, default=0.1)
+    mock.add_argument("--payload-bytes", type=int, default=1500000, help="size of each image, roughly a 1024x1024 PNG")
+    mock.add_argument("--image-size", type=int, default=64)
+    mock.add_argument("--error-rate", type=float, default=0.0)
+    mock.add_argument("--rate-limit", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    if args.level:
+        print(json.dumps(run_level(args, args.level)))
+        return 0
+
+    levels = [int(level) for level in args.concurrency.split(",") if level.strip()]
+    server = None
+    if not args.api_host:
+        server, args.api_host = start_mock_server(args)
+    print(f"Benchmarking {args.model} against {args.api_host}: {args.jobs} request(s) per level", file=sys.stderr)
+    results = []
+    try:
+        for concurrency in levels:
+            if args.in_process:
+                results.append(run_level(args, concurrency))
+            else:
+                results.append(run_level_isolated(args, concurrency))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+    return 1 if any(row["failed"] for row in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+# 本地 Stability API 替身：实现本项目用到的接口，不消耗积分就能测试和压测客户端
+#     python mock_stability_server.py --port 8600 --latency 2 --error-rate 0.05 --rate-limit 10
+#     python stability_engine.py --api-host http://127.0.0.1:8600 --api-key test -o ./output -p "a cat"
+# 只依赖标准库：PNG 用 zlib 手工编码，可通过附加块把每张图片填充到指定大小
+import argparse
+import base64
+import json
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+V2_PATHS = ("/v2beta/stable-image/generate/ultra", "/v2beta/stable-image/generate/core", "/v2beta/stable-image/generate/sd3")
+V1_PATH = re.compile(r"^/v1/generation/([A-Za-z0-9._-]+)/text-to-image$")
+BALANCE_PATH = "/v1/user/balance"
+MODERATED_WORD = "moderate-me"
+
+def png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+def make_png(size=64, payload_bytes=0, seed=0):
+    # 按种子着色的纯色图片；payload_bytes 大于图片本身时用私有附加块填充，模拟真实图片的传输量
+    color = bytes((seed * 67 % 256, seed * 131 % 256, seed * 197 % 256))
+    rows = b"".join(b"\x00" + color * size for _ in range(size))
+    png = b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+    png += png_chunk(b"IDAT", zlib.compress(rows))
+    padding = payload_bytes - len(png) - 24
+    if padding > 0:
+        png += png_chunk(b"myPd", b"\x00" * padding)
+    return png + png_chunk(b"IEND", b"")
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        # 返回 0 表示放行，否则返回需要等待的秒数（用作 Retry-After）
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+class MockStabilityServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, MockStabilityHandler)
+        self.options = options
+        self.bucket = TokenBucket(options.rate_limit, options.burst or max(1, options.rate_limit)) if options.rate_limit > 0 else None
+        self.credits = options.credits
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.counts = {"requests": 0, "images": 0, "429": 0, "5xx": 0}
+        self.lock = threading.Lock()
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.counts[key] += amount
+
+class MockStabilityHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, name, message, headers=None):
+        body = json.dumps({"id": f"{random.getrandbits(64):016x}", "name": name, "errors": [message]}).encode("utf-8")
+        self.send_body(status, body, "application/json", headers)
+
+    def check_auth(self):
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            self.send_error_json(401, "unauthorized", "Missing Authorization header")
+            return False
+        return True
+
+    def inject_failure(self):
+        # 先做限流，再按比例注入 429 和 5xx；都遵循真实 API 的错误格式
+        server = self.server
+        options = server.options
+        if server.bucket is not None:
+            wait = server.bucket.take()
+            if wait:
+                server.count("429")
+                self.send_error_json(429, "rate_limit_exceeded", "You have exceeded the rate limit.", {"Retry-After": str(max(1, round(wait)))})
+                return True
+        if random.random() < options.error_rate:
+            if random.random() < options.error_429_share:
+                server.count("429")
+                self.send_error_json(429, "rate_limit_exceeded", "You have exceeded the rate limit.", {"Retry-After": str(options.retry_after)})
+            else:
+                server.count("5xx")
+                self.send_error_json(random.choice((500, 502, 503)), "server_error", "Injected server error.")
+            return True
+        return False
+
+    def simulate_latency(self):
+        options = self.server.options
+        delay = random.gauss(options.latency, options.jitter) if options.jitter else options.latency
+        if delay > 0:
+            time.sleep(delay)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path != BALANCE_PATH:
+            self.send_error_json(404, "not_found", f"Unknown path {path}")
+            return
+        if not self.check_auth():
+            return
+        self.server.count("requests")
+        if self.inject_failure():
+            return
+        with self.server.lock:
+            credits = self.server.credits
+        self.send_body(200, json.dumps({"credits": credits}).encode("utf-8"), "application/json")
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.read_body()
+        v1_match = V1_PATH.match(path)
+        if path not in V2_PATHS and not v1_match:
+            self.send_error_json(404, "not_found", f"Unknown path {path}")
+            return
+        if not self.check_auth():
+            return
+        server = self.server
+        server.count("requests")
+        with server.lock:
+            server.in_flight += 1
+            server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+        try:
+            if self.inject_failure():
+                return
+            self.simulate_latency()
+            if v1_match:
+                self.generate_v1(body)
+            else:
+                self.generate_v2(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def generate_v1(self, body):
+        try:
+            request = json.loads(body)
+            prompt = " ".join(item.get("text", "") for item in request.get("text_prompts", []))
+            samples = int(request.get("samples", 1))
+            seed = int(request.get("seed") or random.randint(1, 4294967295))
+        except (ValueError, TypeError, AttributeError):
+            self.send_error_json(400, "invalid_json", "Request body is not valid JSON.")
+            return
+        if MODERATED_WORD in prompt:
+            self.send_error_json(400, "invalid_prompts", "One or more prompts contains filtered words.")
+            return
+        self.charge(samples)
+        options = self.server.options
+        if "application/json" in self.headers.get("Accept", ""):
+            artifacts = [{
+                "base64": base64.b64encode(make_png(options.image_size, options.payload_bytes, seed + i)).decode("ascii"),
+                "seed": seed + i,
+                "finishReason": "SUCCESS",
+            } for i in range(samples)]
+            self.send_body(200, json.dumps({"artifacts": artifacts}).encode("utf-8"), "application/json")
+        else:
+            self.send_body(200, make_png(options.image_size, options.payload_bytes, seed), "image/png", {"Seed": str(seed), "Finish-Reason": "SUCCESS"})
+
+    def generate_v2(self, body):
+        # multipart 表单只取需要的字段，不做完整解析
+        fields = dict(re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, re.S))
+        prompt = fields.get(b"prompt", b"").decode("utf-8", "replace")
+        if not prompt:
+            self.send_error_json(400, "invalid_request", "prompt: is required")
+            return
+        if MODERATED_WORD in prompt:
+            self.send_error_json(403, "content_moderation", "Your request was flagged by our content moderation system.")
+            return
+        seed = int(fields.get(b"seed") or 0) or random.randint(1, 4294967295)
+        self.charge(1)
+        options = self.server.options
+        self.send_body(200, make_png(options.image_size, options.payload_bytes, seed), "image/png", {"Seed": str(seed), "Finish-Reason": "SUCCESS"})
+
+    def charge(self, images):
+        server = self.server
+        server.count("images", images)
+        with server.lock:
+            server.credits = max(0.0, server.credits - server.options.credit_cost * images)
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="mock_stability_server", description="Local stand-in for the Stability AI API used by this project.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600, help="0 picks a free port")
+    parser.add_argument("--latency", type=float, default=1.0, help="mean generation time in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="standard deviation of the generation time")
+    parser.add_argument("--payload-bytes", type=int, default=0, help="pad each image to this many bytes")
+    parser.add_argument("--image-size", type=int, default=64, help="width and height of the generated images")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 429 or 5xx")
+    parser.add_argument("--error-429-share", type=float, default=0.5, help="share of injected errors that are 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="requests per second before 429s, 0 disables")
+    parser.add_argument("--burst", type=int, default=0, help="rate limit burst size, defaults to the rate")
+    parser.add_argument("--credits", type=float, default=1000.0, help="starting balance")
+    parser.add_argument("--credit-cost", type=float, default=3.0, help="credits charged per image")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    return parser
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    server = MockStabilityServer((options.host, options.port), options)
+    # 第一行输出实际地址，基准测试以 --port 0 启动时从这里读取端口
+    print(f"http://{server.server_address[0]}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Served {server.counts['requests']} request(s), {server.counts['images']} image(s), "
+              f"{server.counts['429']} 429, {server.counts['5xx']} 5xx, peak {server.peak_in_flight} in flight.", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
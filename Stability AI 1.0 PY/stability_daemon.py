@@ -0,0 +1,392 @@
+# 常驻生成服务：一个后台进程持有 HTTP 连接、生成缓存、任务状态和结果，Resolve 脚本只负责提交任务和取回结果。
+# 关闭窗口不会中断正在执行的任务，结果保留到下次打开脚本时取回；重新打开脚本时复用已有的连接和缓存。
+# 只用标准库 multiprocessing.connection 通信，只监听本机回环地址，用随机 authkey 认证（保存在只有当前用户可读的状态文件中）
+#     python stability_daemon.py              # 前台运行，脚本勾选后台服务时会自动在后台启动
+#     python stability_daemon.py --status
+#     python stability_daemon.py --stop
+import argparse
+import json
+import os
+import secrets
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from stability_engine import (
+    ENGINE_DIR, HTTP_POOL_SIZE, MAX_CONCURRENCY, JobTrace, StabilityAPIError, close_http_session, generate_image_v1,
+    generate_image_v2, generation_history, is_offline_error, metrics, queue_job, run_traced, set_http_pool_size,
+)
+
+DAEMON_FILE = os.path.join(ENGINE_DIR, 'Stability_daemon.json')
+DAEMON_LOG = os.path.join(ENGINE_DIR, 'Stability_daemon.log')
+DAEMON_METRICS_FILE = os.path.join(ENGINE_DIR, 'Stability_daemon.prom')
+DAEMON_HOST = '127.0.0.1'
+DAEMON_IDLE_TIMEOUT = 1800  # 没有客户端连接、也没有任务时，空闲这么久后自动退出
+DAEMON_START_TIMEOUT = 10.0
+DAEMON_WAIT_TIMEOUT = 5.0
+DAEMON_WATCH_INTERVAL = 15.0
+RESULT_TTL = 24 * 3600  # 没人取回的结果保留一天；之后重新提交也会命中生成缓存，不会重复扣积分
+
+GENERATORS = {generate.__name__: generate for generate in (generate_image_v1, generate_image_v2)}
+
+def read_daemon_file(path=DAEMON_FILE):
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            state = json.load(file)
+        return (state["host"], state["port"]), bytes.fromhex(state["authkey"]), state.get("pid")
+    except (OSError, ValueError, KeyError):
+        return None
+
+def write_daemon_file(address, authkey, path=DAEMON_FILE):
+    # 先写临时文件再替换，客户端不会读到写了一半的内容；权限 0600，authkey 只有当前用户可读
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as file:
+        json.dump({"host": address[0], "port": address[1], "authkey": authkey.hex(), "pid": os.getpid(), "started": time.time()}, file)
+    os.replace(temp_path, path)
+
+def remove_daemon_file(path=DAEMON_FILE):
+    # 只删除自己写的状态文件，新启动的服务可能已经覆盖了它
+    state = read_daemon_file(path)
+    if state is not None and state[2] == os.getpid():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+class GenerationDaemon:
+    def __init__(self, idle_timeout=DAEMON_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.jobs = {}  # job_key -> {"client", "trace", "state", "result", "finished"}
+        self.condition = threading.Condition()
+        self.executor = None
+        self.workers = 0
+        self.connections = 0
+        self.last_activity = time.monotonic()
+        self.stopping = False
+        self.listener = None
+        self.authkey = None
+
+    def serve(self, port=0):
+        self.authkey = secrets.token_bytes(32)
+        self.listener = Listener((DAEMON_HOST, port), authkey=self.authkey)
+        write_daemon_file(self.listener.address, self.authkey)
+        print(f"Stability daemon {os.getpid()} listening on {self.listener.address[0]}:{self.listener.address[1]}", flush=True)
+        threading.Thread(target=self.watch, daemon=True).start()
+        try:
+            while not self.stopping:
+                try:
+                    connection = self.listener.accept()
+                except AuthenticationError:
+                    print("Rejected a connection with a wrong authkey.", flush=True)
+                    continue
+                except OSError:
+                    if self.stopping:
+                        break
+                    raise
+                threading.Thread(target=self.handle_connection, args=(connection,), daemon=True).start()
+        finally:
+            self.listener.close()
+            remove_daemon_file()
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+            metrics.write_prometheus(DAEMON_METRICS_FILE)
+            close_http_session()
+            generation_history.close()
+            print("Stability daemon stopped.", flush=True)
+
+    def stop(self):
+        # accept() 阻塞时关闭监听不一定能唤醒它，连一次自己让循环看到停止标志
+        self.stopping = True
+        try:
+            Client(self.listener.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+
+    def watch(self):
+        # 定期导出指标、清理过期结果，空闲超时后退出
+        while not self.stopping:
+            time.sleep(DAEMON_WATCH_INTERVAL)
+            metrics.write_prometheus(DAEMON_METRICS_FILE)
+            now = time.monotonic()
+            with self.condition:
+                for job_key, job in list(self.jobs.items()):
+                    if job["finished"] is not None and now - job["finished"] > RESULT_TTL:
+                        del self.jobs[job_key]
+                busy = self.connections or any(job["finished"] is None for job in self.jobs.values())
+                if busy:
+                    self.last_activity = now
+                idle = now - self.last_activity
+            if self.idle_timeout and idle > self.idle_timeout:
+                print(f"Idle for {idle:.0f} s, exiting.", flush=True)
+                self.stop()
+
+    def handle_connection(self, connection):
+        with self.condition:
+            self.connections += 1
+        try:
+            while not self.stopping:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    break
+                try:
+                    response = dict(getattr(self, f"op_{request['op']}")(request), ok=True)
+                except Exception as e:
+                    response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                try:
+                    connection.send(response)
+                except OSError:
+                    break
+        finally:
+            connection.close()
+            with self.condition:
+                self.connections -= 1
+                self.last_activity = time.monotonic()
+
+    def get_executor(self, workers):
+        # 与脚本中的线程池相同：并发数变化时换一个新的线程池，旧线程池中的任务仍会执行完
+        workers = max(1, min(workers, MAX_CONCURRENCY))
+        if self.executor is None or workers != self.workers:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+            self.workers = workers
+            set_http_pool_size(max(HTTP_POOL_SIZE, workers))
+        return self.executor
+
+    def op_ping(self, request):
+        with self.condition:
+            states = [job["state"] for job in self.jobs.values()]
+        return {"pid": os.getpid(), "jobs": {state: states.count(state) for state in set(states)}}
+
+    def op_submit(self, request):
+        job_key = request["job_key"]
+        generate = GENERATORS[request["generate"]]
+        with self.condition:
+            job = self.jobs.get(job_key)
+            if job is not None:
+                # 同一个任务已经在执行或有未取回的结果（例如脚本重启后重新提交），只转交结果的接收方
+                job["client"] = request["client"]
+                self.condition.notify_all()
+                return {"state": job["state"]}
+            trace = JobTrace(job=job_key)
+            trace.trace_id = request.get("trace_id") or trace.trace_id
+            self.jobs[job_key] = {"client": request["client"], "trace": trace, "state": "queued", "result": None, "finished": None}
+            executor = self.get_executor(request.get("workers", 1))
+        queue_job()
+        executor.submit(self.run_job, job_key, trace, generate, tuple(request["args"]))
+        return {"state": "queued"}
+
+    def op_attach(self, request):
+        # 脚本重启后认领上一次会话提交的任务，返回这里仍有记录的任务及其追踪 ID
+        known = {}
+        with self.condition:
+            for job_key in request["job_keys"]:
+                job = self.jobs.get(job_key)
+                if job is not None:
+                    job["client"] = request["client"]
+                    known[job_key] = job["trace"].trace_id
+            self.condition.notify_all()
+        return {"jobs": known}
+
+    def op_wait(self, request):
+        # 长轮询：先确认上一批结果，再等待属于该客户端的新结果
+        client = request["client"]
+        deadline = time.monotonic() + min(request.get("timeout", DAEMON_WAIT_TIMEOUT), 60.0)
+        with self.condition:
+            for job_key in request.get("ack", ()):
+                job = self.jobs.get(job_key)
+                if job is not None and job["finished"] is not None:
+                    del self.jobs[job_key]
+            while True:
+                results = [job["result"] for job in self.jobs.values() if job["client"] == client and job["result"] is not None]
+                remaining = deadline - time.monotonic()
+                if results or remaining <= 0 or self.stopping:
+                    return {"results": results}
+                self.condition.wait(remaining)
+
+    def op_metrics(self, request):
+        return {"metrics": metrics.snapshot()}
+
+    def op_shutdown(self, request):
+        threading.Thread(target=self.stop, daemon=True).start()
+        return {}
+
+    def run_job(self, job_key, trace, generate, args):
+        with self.condition:
+            self.jobs[job_key]["state"] = "running"
+        error = None
+        try:
+            image_paths = run_traced(trace, generate, args)
+            state = "done" if image_paths else "failed"
+        except StabilityAPIError as e:
+            image_paths, error = None, str(e)
+            state = "offline" if is_offline_error(e) else "failed"
+        except Exception as e:
+            image_paths, error = None, str(e)
+            state = "failed"
+        print(f"[{trace.trace_id}] Job {job_key}: {state}", flush=True)
+        # 追踪记录交给脚本补上导入耗时后再写日志
+        with trace.lock:
+            stages, fields = dict(trace.stages), dict(trace.fields)
+        with self.condition:
+            job = self.jobs.get(job_key)
+            if job is None:
+                return
+            job["state"] = state
+            job["finished"] = time.monotonic()
+            job["result"] = {"job_key": job_key, "state": state, "files": image_paths or [], "error": error, "stages": stages, "fields": fields}
+            self.condition.notify_all()
+
+# 客户端：脚本中使用。一个连接用于提交和查询，另一个后台线程用长轮询取回结果
+class DaemonClient:
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self.client_id = uuid.uuid4().hex
+        self.connection = Client(address, authkey=authkey)
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def request(self, op, **fields):
+        with self.lock:
+            self.connection.send(dict(fields, op=op))
+            response = self.connection.recv()
+        if not response.get("ok"):
+            raise RuntimeError(response.get("error"))
+        return response
+
+    def ping(self):
+        return self.request("ping")
+
+    def submit(self, job_key, trace_id, generate_name, args, workers):
+        return self.request("submit", client=self.client_id, job_key=job_key, trace_id=trace_id, generate=generate_name, args=list(args), workers=workers)
+
+    def attach(self, job_keys):
+        return self.request("attach", client=self.client_id, job_keys=list(job_keys))["jobs"]
+
+    def metrics(self):
+        return self.request("metrics")["metrics"]
+
+    def shutdown(self):
+        return self.request("shutdown")
+
+    def listen(self, on_result, on_disconnect=None):
+        # on_result(result) 在后台线程中调用，返回后才确认该结果；服务退出时调用 on_disconnect(error)
+        def listen_loop():
+            error = None
+            acknowledged = []
+            try:
+                connection = Client(self.address, authkey=self.authkey)
+                try:
+                    while not self.closed:
+                        connection.send({"op": "wait", "client": self.client_id, "ack": acknowledged, "timeout": DAEMON_WAIT_TIMEOUT})
+                        response = connection.recv()
+                        acknowledged = []
+                        for result in response.get("results", []):
+                            try:
+                                on_result(result)
+                            except Exception as e:
+                                print(f"Error: {e}")
+                            acknowledged.append(result["job_key"])
+                finally:
+                    connection.close()
+            except (EOFError, OSError) as e:
+                error = e
+            if not self.closed and on_disconnect:
+                on_disconnect(error)
+
+        threading.Thread(target=listen_loop, daemon=True).start()
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            self.connection.close()
+
+def python_executable():
+    # Resolve 内嵌的解释器中 sys.executable 指向 Resolve 本身，改用 $STABILITY_DAEMON_PYTHON 或 PATH 中的 Python
+    configured = os.environ.get("STABILITY_DAEMON_PYTHON")
+    if configured:
+        return configured
+    if os.path.basename(sys.executable or '').lower().startswith("python"):
+        return sys.executable
+    return shutil.which("python3") or shutil.which("python")
+
+def start_daemon():
+    python = python_executable()
+    if not python:
+        raise OSError("No Python interpreter found to start the daemon, set STABILITY_DAEMON_PYTHON.")
+    options = {}
+    if sys.platform == "win32":
+        options["creationflags"] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        options["start_new_session"] = True
+    with open(DAEMON_LOG, 'a', encoding='utf-8') as log:
+        return subprocess.Popen([python, os.path.abspath(__file__)], stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                cwd=ENGINE_DIR, close_fds=True, **options)
+
+def connect_daemon(start=True, timeout=DAEMON_START_TIMEOUT):
+    # 连接正在运行的服务；没有运行时按需在后台启动，等它写出状态文件后再连接
+    state = read_daemon_file()
+    if state is not None:
+        try:
+            return DaemonClient(state[0], state[1])
+        except (OSError, AuthenticationError):
+            pass
+    if not start:
+        raise ConnectionError("The Stability daemon is not running.")
+    process = start_daemon()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(0.1)
+        if process.poll() is not None:
+            raise ConnectionError(f"The Stability daemon exited with {process.returncode}, see {DAEMON_LOG}.")
+        state = read_daemon_file()
+        if state is not None and state[2] == process.pid:
+            return DaemonClient(state[0], state[1])
+    raise ConnectionError(f"The Stability daemon did not start within {timeout:g} s, see {DAEMON_LOG}.")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="stability_daemon", description="Background generation service shared by launches of the Resolve script.")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--idle-timeout", type=float, default=DAEMON_IDLE_TIMEOUT, help="seconds without clients or jobs before exiting, 0 never exits")
+    parser.add_argument("--status", action="store_true", help="show whether the daemon is running")
+    parser.add_argument("--stop", action="store_true", help="stop the running daemon")
+    args = parser.parse_args(argv)
+
+    if args.status or args.stop:
+        try:
+            client = connect_daemon(start=False)
+        except ConnectionError as e:
+            print(e)
+            return 1
+        status = client.ping()
+        print(f"Stability daemon {status['pid']} running at {client.address[0]}:{client.address[1]}, jobs: {status['jobs'] or 'none'}")
+        if args.stop:
+            client.shutdown()
+            print("Stop requested.")
+        client.close()
+        return 0
+
+    state = read_daemon_file()
+    if state is not None:
+        try:
+            DaemonClient(state[0], state[1]).close()
+            print(f"A Stability daemon is already running (pid {state[2]}).")
+            return 1
+        except (OSError, AuthenticationError):
+            pass
+    # 后台启动时输出重定向到日志文件，按行刷新
+    sys.stdout.reconfigure(line_buffering=True)
+    GenerationDaemon(args.idle_timeout).serve(args.port)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1799 @@
+# Stability AI 生成引擎：请求构建、HTTP、缓存、历史记录和文件写入，不依赖 DaVinci Resolve / Fusion。
+# Resolve 脚本导入它来生成图片，也可以在命令行中批量运行：
+#     python stability_engine.py -o ./output -m core prompts.txt
+import argparse
+import base64
+import collections
+import contextlib
+import hashlib
+import importlib
+import importlib.util
+import itertools
+import json
+import math
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# 延迟导入：requests、Pillow、numpy 和 email.utils 合计要一两百毫秒，第一次使用时才加载，不拖慢脚本启动
+class LazyModule:
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def load(self):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+    def available(self):
+        # 只查找模块，不执行导入
+        if self.module is not None:
+            return True
+        try:
+            return importlib.util.find_spec(self.name) is not None
+        except ImportError:
+            return False
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+requests = LazyModule("requests")
+Image = LazyModule("PIL.Image")
+ImageDraw = LazyModule("PIL.ImageDraw")
+np = LazyModule("numpy")
+email_utils = LazyModule("email.utils")
+
+ENGINE_DIR = os.path.dirname(os.path.abspath(__file__))
+MAX_CONCURRENCY = 8
+
+# 状态消息：默认打印到控制台，Resolve 脚本替换为更新界面的函数
+status_handler = print
+
+def set_status_handler(handler):
+    global status_handler
+    status_handler = handler
+
+def update_status(message):
+    # 任务线程中的状态消息带上追踪 ID，和追踪日志中的记录对应
+    trace = current_trace()
+    if trace is not None:
+        message = f"[{trace.trace_id}] {message}"
+    status_handler(message)
+
+# 请求追踪：每个任务记录排队、建连（DNS + TCP）、TLS、首字节、下载、写盘和导入各阶段耗时，
+# 以及字节数、状态码和重试次数，写入按大小轮转的 JSONL 日志，用来判断慢在 API、网络还是 Resolve 导入
+TRACE_FILE = os.path.join(ENGINE_DIR, 'Stability_trace.jsonl')
+TRACE_MAX_BYTES = 5 * 1024 * 1024
+TRACE_BACKUPS = 3
+
+class TraceLog:
+    def __init__(self, path, max_bytes=TRACE_MAX_BYTES, backups=TRACE_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+                    self._rotate()
+                with open(self.path, 'a', encoding='utf-8') as file:
+                    file.write(line)
+            except OSError as e:
+                print(f"Error writing trace log: {e}")
+
+    def _rotate(self):
+        # Stability_trace.jsonl -> .1 -> .2 ...，超出保留数量的最旧文件被覆盖
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+trace_log = TraceLog(TRACE_FILE)
+
+class JobTrace:
+    def __init__(self, **fields):
+        self.trace_id = uuid.uuid4().hex[:8]
+        self.created = time.perf_counter()
+        self.stages = {}
+        self.fields = {"bytes": 0, "retries": 0}
+        self.fields.update(fields)
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        # 从创建（入队）到开始执行的时间计为排队
+        self.add("queue", time.perf_counter() - self.created)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def seconds(self, *stages):
+        with self.lock:
+            return sum(self.stages.get(stage, 0.0) for stage in stages)
+
+    def count(self, field, amount=1):
+        with self.lock:
+            self.fields[field] = self.fields.get(field, 0) + amount
+
+    def update(self, **fields):
+        with self.lock:
+            self.fields.update(fields)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def finish(self, outcome):
+        # 导入完成或失败时写入一次，之后的调用忽略
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+            record = {
+                "trace": self.trace_id,
+                "time": round(time.time(), 3),
+                "outcome": outcome,
+                "total": round(time.perf_counter() - self.created, 4),
+                "stages": {stage: round(seconds, 4) for stage, seconds in self.stages.items()},
+            }
+            record.update(self.fields)
+        trace_log.write(record)
+
+# 当前线程正在执行的任务，HTTP 和写文件的代码通过它记录耗时，不需要逐层传参
+trace_context = threading.local()
+
+def current_trace():
+    return getattr(trace_context, "trace", None)
+
+@contextlib.contextmanager
+def active_trace(trace):
+    previous = current_trace()
+    trace_context.trace = trace
+    try:
+        yield trace
+    finally:
+        trace_context.trace = previous
+
+def trace_stage(name):
+    trace = current_trace()
+    return trace.stage(name) if trace is not None else contextlib.nullcontext()
+
+def trace_add(stage, seconds):
+    trace = current_trace()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+def trace_update(**fields):
+    trace = current_trace()
+    if trace is not None:
+        trace.update(**fields)
+
+def queue_job():
+    metrics.add_gauge("queued", 1)
+
+def run_traced(trace, generate, args):
+    # 与 queue_job 配对：从排队转为执行中；没有产出图片计为失败，API 不可用单独计数（任务之后会重新提交）
+    trace.start()
+    metrics.add_gauge("queued", -1)
+    metrics.add_gauge("in_flight", 1)
+    try:
+        with active_trace(trace):
+            image_paths = generate_with_key_pool(generate, args)
+    except StabilityAPIError as e:
+        metrics.inc("offline" if is_offline_error(e) else "failed")
+        raise
+    except Exception:
+        metrics.inc("failed")
+        raise
+    finally:
+        metrics.add_gauge("in_flight", -1)
+    if not image_paths:
+        metrics.inc("failed")
+    return image_paths
+
+# 共享 HTTP 会话：复用到 api.stability.ai 的 keep-alive 连接，避免每次请求重新握手
+API_HOST = os.environ.get('STABILITY_API_HOST', 'https://api.stability.ai')
+HTTP_POOL_SIZE = 4
+http_pool_size = HTTP_POOL_SIZE
+http_sessions = {}  # api_key -> (pool_size, session)；使用多个 Key 时每个 Key 保留自己的连接池，轮换 Key 不会断开连接
+http_session_lock = threading.Lock()
+tracing_adapter_class = None
+
+def timed_connection_class(base, tls):
+    # 新建连接时把 DNS + TCP 和 TLS 握手耗时记入当前任务；复用的 keep-alive 连接不会经过这里
+    class TimedConnection(base):
+        def _new_conn(self):
+            started = time.perf_counter()
+            try:
+                return super()._new_conn()
+            finally:
+                self.connect_seconds = time.perf_counter() - started
+                trace_add("connect", self.connect_seconds)
+
+        def connect(self):
+            started = time.perf_counter()
+            self.connect_seconds = 0.0
+            super().connect()
+            trace = current_trace()
+            if trace is not None:
+                trace.count("connections")
+                if tls:
+                    trace.add("tls", time.perf_counter() - started - self.connect_seconds)
+
+    return TimedConnection
+
+def get_tracing_adapter_class():
+    # requests 延迟导入，第一次创建会话时才定义适配器
+    global tracing_adapter_class
+    if tracing_adapter_class is None:
+        from urllib3.connection import HTTPConnection, HTTPSConnection
+        from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+        class TracingHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = timed_connection_class(HTTPConnection, False)
+
+        class TracingHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = timed_connection_class(HTTPSConnection, True)
+
+        class TracingHTTPAdapter(requests.adapters.HTTPAdapter):
+            def init_poolmanager(self, *args, **kwargs):
+                super().init_poolmanager(*args, **kwargs)
+                self.poolmanager.pool_classes_by_scheme = {"http": TracingHTTPConnectionPool, "https": TracingHTTPSConnectionPool}
+
+        tracing_adapter_class = TracingHTTPAdapter
+    return tracing_adapter_class
+
+def get_http_session(api_key: str, pool_size: int = None) -> "requests.Session":
+    pool_size = pool_size or http_pool_size
+    with http_session_lock:
+        cached = http_sessions.get(api_key)
+        if cached is None or cached[0] != pool_size:
+            session = requests.Session()
+            adapter = get_tracing_adapter_class()(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({
+                "Authorization": f"Bearer {api_key}",
+                "Connection": "keep-alive",
+            })
+            # 旧会话可能仍有请求在进行，交给垃圾回收关闭
+            http_sessions[api_key] = (pool_size, session)
+            return session
+        return cached[1]
+
+def set_http_pool_size(size):
+    global http_pool_size
+    http_pool_size = size
+
+def close_http_session():
+    with http_session_lock:
+        for _, session in http_sessions.values():
+            session.close()
+        http_sessions.clear()
+
+# 重试：区分可重试错误，遵循 Retry-After，指数退避加抖动；熔断器让批量任务停止冲击故障端点
+HTTP_TIMEOUT = (10, 120)  # (连接, 读取) 秒
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRY_AFTER_LIMIT = 120.0
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+class StabilityAPIError(Exception):
+    def __init__(self, message, status_code=None, name=None, retryable=False, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.name = name
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            # 冷却结束后只放行一个试探请求（半开状态）
+            if time.monotonic() - self.opened_at >= self.reset_timeout and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+    def record_throttled(self):
+        # 429 或意外异常：不计入失败，只交还半开状态的试探名额，否则熔断器会一直打开
+        with self.lock:
+            self.trial_running = False
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(url):
+    with circuit_breakers_lock:
+        if url not in circuit_breakers:
+            circuit_breakers[url] = CircuitBreaker()
+        return circuit_breakers[url]
+
+# 共享限流：同一台机器上使用同一 API Key 的所有线程和脚本实例共用一个令牌桶。
+# 状态保存在临时目录中以 Key 哈希命名的文件里，读写时加文件锁；收到 429 时所有实例一起暂停到 Retry-After 之后
+RATE_LIMIT = float(os.environ.get("STABILITY_RATE_LIMIT", 15.0))  # 每秒请求数，Stability 的限制为每 10 秒 150 次
+RATE_LIMIT_BURST = 15
+RATE_LIMIT_MAX_SLEEP = 1.0
+RATE_LIMIT_DIR = tempfile.gettempdir()
+
+@contextlib.contextmanager
+def locked_file(path):
+    with open(path, 'a+b') as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield file
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+class SharedTokenBucket:
+    def __init__(self, path, rate=RATE_LIMIT, burst=RATE_LIMIT_BURST):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+
+    def _update(self, change):
+        # 进程间用挂钟时间；文件不存在或损坏时从满桶开始
+        with self.lock, locked_file(self.path) as file:
+            file.seek(0)
+            try:
+                state = json.loads(file.read() or b"{}")
+            except ValueError:
+                state = {}
+            now = time.time()
+            elapsed = max(0.0, now - state.get("updated", now))
+            state["tokens"] = min(self.burst, state.get("tokens", self.burst) + elapsed * self.rate)
+            state["updated"] = now
+            result = change(state, now)
+            # 追加模式下截断后写入即从文件开头写；必须在解锁前 flush，否则其他进程可能读到空文件
+            file.truncate(0)
+            file.write(json.dumps(state).encode("utf-8"))
+            file.flush()
+        return result
+
+    def try_acquire(self):
+        # 返回 0 表示拿到令牌，否则返回还需等待的秒数
+        def take(state, now):
+            blocked = state.get("blocked_until", 0.0) - now
+            if blocked > 0:
+                return blocked
+            if state["tokens"] >= 1:
+                state["tokens"] -= 1
+                return 0.0
+            return (1 - state["tokens"]) / self.rate
+        return self._update(take)
+
+    def acquire(self):
+        # 阻塞到拿到令牌，返回等待的总秒数；文件无法访问时不限流
+        waited = 0.0
+        while True:
+            try:
+                wait = self.try_acquire()
+            except OSError as e:
+                print(f"Rate limiter unavailable: {e}")
+                return waited
+            if wait <= 0:
+                return waited
+            wait = min(wait, RATE_LIMIT_MAX_SLEEP)
+            time.sleep(wait)
+            waited += wait
+
+    def block(self, seconds):
+        def extend(state, now):
+            state["blocked_until"] = max(state.get("blocked_until", 0.0), now + seconds)
+            state["tokens"] = 0.0
+        try:
+            self._update(extend)
+        except OSError as e:
+            print(f"Rate limiter unavailable: {e}")
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(session):
+    if RATE_LIMIT <= 0:
+        return None
+    # 文件名只用 Key 的哈希，不把 Key 写到磁盘上
+    digest = hashlib.sha256(session.headers.get("Authorization", "").encode("utf-8")).hexdigest()[:16]
+    with rate_limiters_lock:
+        if digest not in rate_limiters:
+            rate_limiters[digest] = SharedTokenBucket(os.path.join(RATE_LIMIT_DIR, f"stability-rate-{digest}.json"), RATE_LIMIT, max(1, RATE_LIMIT_BURST))
+        return rate_limiters[digest]
+
+def set_rate_limit(rate, burst=None):
+    global RATE_LIMIT, RATE_LIMIT_BURST
+    with rate_limiters_lock:
+        RATE_LIMIT = rate
+        RATE_LIMIT_BURST = burst or max(1, int(rate))
+        rate_limiters.clear()
+
+# 自适应并发（AIMD）：收到 429 时把同时进行的请求数减半，延迟正常（不超过该端点最低延迟的两倍）时
+# 每完成一个请求加 1/limit，大约每轮加 1，逐步恢复到上限
+ADAPTIVE_DECREASE_COOLDOWN = 5.0
+ADAPTIVE_LATENCY_TOLERANCE = 2.0
+ADAPTIVE_BASELINE_DRIFT = 1.05
+
+class AdaptiveConcurrency:
+    def __init__(self, maximum=MAX_CONCURRENCY, enabled=True):
+        self.maximum = maximum
+        self.enabled = enabled
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.baselines = {}  # url -> 最低延迟，缓慢上浮以跟随服务端变化
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.enabled and self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, url, latency=None, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if not self.enabled:
+                pass
+            elif throttled:
+                # 同一波 429 只减一次
+                if time.monotonic() - self.last_decrease >= ADAPTIVE_DECREASE_COOLDOWN:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = time.monotonic()
+                    print(f"Rate limited, reducing concurrency to {int(self.limit)}.")
+            elif latency is not None:
+                baseline = min(latency, self.baselines.get(url, latency) * ADAPTIVE_BASELINE_DRIFT)
+                self.baselines[url] = baseline
+                if latency <= baseline * ADAPTIVE_LATENCY_TOLERANCE:
+                    self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+        metrics.set_gauge("concurrency_limit", int(self.limit))
+
+adaptive_concurrency = AdaptiveConcurrency()
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email_utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def error_from_response(response):
+    # 错误内容不一定是 JSON（例如网关返回的 HTML）
+    try:
+        payload = response.json()
+    except ValueError:
+        payload = {}
+    if not isinstance(payload, dict):
+        payload = {}
+    name = payload.get("name")
+    detail = payload.get("errors") or payload.get("message") or response.text[:500]
+    return StabilityAPIError(
+        f"HTTP {response.status_code} {name}: {detail}" if name else f"HTTP {response.status_code}: {detail}",
+        status_code=response.status_code,
+        name=name,
+        retryable=response.status_code in RETRYABLE_STATUS,
+        retry_after=parse_retry_after(response.headers.get("Retry-After")),
+    )
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+def trace_response(response, started, connecting, stream):
+    # response.elapsed 到收到响应头为止，包含建连；非流式请求返回前已读完响应体
+    trace = current_trace()
+    if trace is None:
+        return
+    headers_at = response.elapsed.total_seconds()
+    trace.add("ttfb", max(0.0, headers_at - (trace.seconds("connect", "tls") - connecting)))
+    trace.update(status=response.status_code)
+    if not stream:
+        trace.add("download", max(0.0, time.perf_counter() - started - headers_at))
+        trace.count("bytes", len(response.content))
+
+# 流式请求的响应体错误要在重试循环里处理：read_body(response) 在同一次尝试中读取响应体，
+# 下载中途断开或超时与连接失败一样重试，重试耗尽后按 API 不可用处理
+BODY_NETWORK_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+def request_with_retry(session, method, url, read_body=None, **kwargs):
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    breaker = get_circuit_breaker(url)
+    limiter = get_rate_limiter(session)
+    trace = current_trace()
+    for attempt in range(1, RETRY_ATTEMPTS + 1):
+        if not breaker.allow():
+            trace_update(status="circuit_open")
+            raise StabilityAPIError(f"Circuit open for {url}, skipping request.", name="circuit_open")
+        try:
+            # 每次尝试（包括重试）都要拿令牌和并发名额
+            if limiter is not None:
+                trace_add("rate_limit", limiter.acquire())
+            with trace_stage("concurrency_wait"):
+                adaptive_concurrency.acquire()
+            started = time.perf_counter()
+            connecting = trace.seconds("connect", "tls") if trace is not None else 0.0
+            response = None
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = StabilityAPIError(f"Network error: {e}", name="network_error", retryable=True)
+                trace_update(status="network_error")
+            else:
+                trace_response(response, started, connecting, kwargs.get("stream", False))
+                if response.status_code == 200:
+                    if read_body is None:
+                        breaker.record_success()
+                        return response
+                    try:
+                        result = read_body(response)
+                    except BODY_NETWORK_ERRORS as e:
+                        error = StabilityAPIError(f"Network error while downloading: {e}", name="network_error", retryable=True)
+                        trace_update(status="network_error")
+                    else:
+                        breaker.record_success()
+                        return result
+                else:
+                    error = error_from_response(response)
+                    response.close()
+            finally:
+                # 只有成功的请求提供延迟样本
+                status = response.status_code if response is not None else None
+                adaptive_concurrency.release(url, time.perf_counter() - started if status == 200 else None, status == 429)
+        except BaseException:
+            breaker.record_throttled()
+            raise
+        if not error.retryable:
+            # 4xx（参数校验、内容审核等）说明端点本身正常
+            breaker.record_success()
+            raise error
+        if error.status_code == 429:
+            # 429 只说明请求太快，由限流和自适应并发处理，不算端点故障
+            breaker.record_throttled()
+        else:
+            breaker.record_failure()
+        if attempt == RETRY_ATTEMPTS:
+            raise error
+        if error.retry_after is not None:
+            delay = min(error.retry_after, RETRY_AFTER_LIMIT)
+        else:
+            delay = backoff_delay(attempt)
+        if error.status_code == 429 and limiter is not None:
+            # 让其他线程和脚本实例也暂停，而不是各自撞上 429
+            limiter.block(delay)
+        print(f"Retrying in {delay:.1f}s ({attempt}/{RETRY_ATTEMPTS - 1}): {error}")
+        if trace is not None:
+            trace.count("retries")
+            trace.add("retry_wait", delay)
+        time.sleep(delay)
+
+# 流式下载：分块写入输出目录中的临时文件，完整后原子重命名，失败时不留下半张图片
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def save_response_to_file(response, output_file):
+    directory = os.path.dirname(output_file) or "."
+    fd, temp_path = tempfile.mkstemp(prefix=".stability-", suffix=".part", dir=directory)
+    # 接收和写盘交替进行，分别累计耗时
+    started = time.perf_counter()
+    writing = 0.0
+    received = 0
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if chunk:
+                    write_started = time.perf_counter()
+                    file.write(chunk)
+                    writing += time.perf_counter() - write_started
+                    received += len(chunk)
+            write_started = time.perf_counter()
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, output_file)
+        writing += time.perf_counter() - write_started
+        trace = current_trace()
+        if trace is not None:
+            trace.add("download", time.perf_counter() - started - writing)
+            trace.add("write", writing)
+            trace.count("bytes", received)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    finally:
+        response.close()
+
+# 输出文件命名：模型_种子_时间戳_进程号-序号，独占创建来预留文件名，不再逐个探测已有文件
+output_sequence = itertools.count(1)
+
+def allocate_output_file(directory, model, seed, extension, sequence=None):
+    if sequence:
+        # 帧序列中的一帧：<序列名>_0001.png
+        name, frame = sequence
+        path = os.path.join(directory, f"{name}_{frame:04d}.{extension}")
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return path
+    model_name = re.sub(r"[^A-Za-z0-9.-]+", "-", str(model))
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    while True:
+        path = os.path.join(directory, f"{model_name}_{seed}_{timestamp}_{os.getpid()}-{next(output_sequence):04d}.{extension}")
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return path
+
+def allocate_sequence_name(model):
+    model_name = re.sub(r"[^A-Za-z0-9.-]+", "-", str(model))
+    return f"{model_name}_seq-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(output_sequence):04d}"
+
+def release_output_file(path):
+    # 删除生成失败时预留的空文件
+    if path:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# 多张图片：V1 接口以 JSON 返回 base64 图片，并行解码写入，每张使用自己的 seed
+MAX_SAMPLES = 10
+ARTIFACT_WORKERS = 4
+
+def save_artifacts(response, allocate):
+    artifacts = response.json().get("artifacts", [])
+    response.close()
+
+    def write_artifact(artifact):
+        finish_reason = artifact.get("finishReason", "SUCCESS")
+        if finish_reason != "SUCCESS":
+            print(f"Skipping sample with seed {artifact.get('seed')}: {finish_reason}")
+            return None
+        output_file = allocate(artifact.get("seed"))
+        temp_path = f"{output_file}.part"
+        try:
+            with open(temp_path, 'wb') as file:
+                file.write(base64.b64decode(artifact["base64"]))
+            os.replace(temp_path, output_file)
+        except (KeyError, ValueError, OSError) as e:
+            release_output_file(temp_path)
+            release_output_file(output_file)
+            print(f"Error writing sample with seed {artifact.get('seed')}: {e}")
+            return None
+        return output_file
+
+    if not artifacts:
+        return []
+    with trace_stage("write"), ThreadPoolExecutor(max_workers=min(len(artifacts), ARTIFACT_WORKERS)) as executor:
+        return [path for path in executor.map(write_artifact, artifacts) if path]
+
+def get_remaining_credits(api_key: str) -> float:
+    url = f"{API_HOST}/v1/user/balance"
+
+    response = request_with_retry(get_http_session(api_key), "GET", url)
+    payload = response.json()
+    credits = payload.get("credits", 0.0)
+    return round(credits, 1)
+
+# 积分缓存：懒加载余额并按 TTL 缓存，每次生成后按模型单价本地扣减，过期后在后台刷新
+CREDIT_TTL = 300.0
+# 每张图片的积分估算值，V1 模型按默认步数估算
+MODEL_CREDIT_COST = {
+    "ultra": 8.0,
+    "core": 3.0,
+    "sd3-large": 6.5,
+    "sd3-large-turbo": 4.0,
+    "sd3-medium": 3.5,
+    "stable-diffusion-v1-6": 0.9,
+    "stable-diffusion-xl-1024-v1-0": 0.6,
+}
+
+def estimate_credits(model, images=1):
+    return MODEL_CREDIT_COST.get(model, 0.0) * images
+
+class CreditTracker:
+    def __init__(self, ttl=CREDIT_TTL):
+        self.ttl = ttl
+        self.balances = {}  # api_key -> (credits, fetched_at)
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def peek(self, api_key):
+        # 不发起网络请求；缓存过期时触发后台刷新
+        with self.lock:
+            cached = self.balances.get(api_key)
+        if cached is None or time.monotonic() - cached[1] > self.ttl:
+            self.refresh_async(api_key)
+        return cached[0] if cached else None
+
+    def fetch(self, api_key):
+        credits = get_remaining_credits(api_key)
+        with self.lock:
+            self.balances[api_key] = (credits, time.monotonic())
+        return credits
+
+    def refresh_async(self, api_key, callback=None):
+        with self.lock:
+            if api_key in self.refreshing and callback is None:
+                return
+            self.refreshing.add(api_key)
+
+        def refresh():
+            credits, error = None, None
+            try:
+                credits = self.fetch(api_key)
+            except Exception as e:
+                error = e
+            finally:
+                with self.lock:
+                    self.refreshing.discard(api_key)
+            if callback:
+                callback(credits, error)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def charge(self, api_key, model, images=1):
+        with self.lock:
+            cached = self.balances.get(api_key)
+            if cached is not None:
+                self.balances[api_key] = (round(max(0.0, cached[0] - estimate_credits(model, images)), 1), cached[1])
+        if cached is None or time.monotonic() - cached[1] > self.ttl:
+            self.refresh_async(api_key)
+
+credit_tracker = CreditTracker()
+
+# API Key 池：配置中可以填写多个 Key（逗号或空白分隔），每个 Key 有自己的共享限流桶和余额缓存。
+# 任务分给执行中任务最少、余额足够的 Key；返回 401/402 的 Key 被停用，任务自动换下一个 Key 重试
+KEY_ERROR_STATUS = {401, 402}
+
+def parse_api_keys(text):
+    keys = []
+    for key in re.split(r"[\s,;]+", text or ''):
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+MASK_MIN_KEY_LENGTH = 8
+
+def mask_api_key(key):
+    # 任务服务器的访问令牌可能很短，露出后四位就等于公开整个令牌
+    if len(key) < MASK_MIN_KEY_LENGTH:
+        return "****"
+    return f"...{key[-4:]}"
+
+def is_key_error(error):
+    return error.status_code in KEY_ERROR_STATUS
+
+def job_credits(args):
+    # V1 任务参数为 (settings, engine_id)，V2 为 (settings,)
+    settings = args[0]
+    if len(args) > 1:
+        return estimate_credits(args[1], settings.get("SAMPLES", 1))
+    return estimate_credits(settings.get("MODEL_V2"))
+
+class ApiKeyPool:
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.in_flight = collections.Counter()
+        self.disabled = {}  # key -> 停用原因
+        self.lock = threading.Lock()
+
+    def usable_keys(self):
+        with self.lock:
+            return [key for key in self.keys if key not in self.disabled]
+
+    def acquire(self, credits=0.0):
+        # 余额未知（还没查询过）的 Key 视为足够，peek 会在后台查询；同样负载时优先余额多的 Key
+        with self.lock:
+            candidates = []
+            for index, key in enumerate(self.keys):
+                if key in self.disabled:
+                    continue
+                balance = credit_tracker.peek(key)
+                if balance is not None and balance < credits:
+                    continue
+                candidates.append((self.in_flight[key], -(balance or 0.0), index, key))
+            if not candidates:
+                raise StabilityAPIError("No API key with enough credits is available.", name="no_api_key")
+            key = min(candidates)[3]
+            self.in_flight[key] += 1
+            return key
+
+    def release(self, key):
+        with self.lock:
+            self.in_flight[key] -= 1
+
+    def disable(self, key, reason):
+        with self.lock:
+            self.disabled[key] = reason
+        print(f"API key {mask_api_key(key)} disabled: {reason}")
+
+    def total_credits(self):
+        # 任何一个可用 Key 的余额未知时返回 None，无法判断是否足够
+        balances = [credit_tracker.peek(key) for key in self.usable_keys()]
+        if not balances or None in balances:
+            return None
+        return round(sum(balances), 1)
+
+    def refresh_async(self, callback=None):
+        # 并发查询全部 Key 的余额；callback(key -> 余额或异常)。查询成功且有余额的 Key 重新启用
+        def refresh():
+            results = {}
+            with ThreadPoolExecutor(max_workers=max(1, len(self.keys))) as executor:
+                futures = {executor.submit(credit_tracker.fetch, key): key for key in self.keys}
+                for future in as_completed(futures):
+                    try:
+                        results[futures[future]] = future.result()
+                    except Exception as e:
+                        results[futures[future]] = e
+            with self.lock:
+                for key, result in results.items():
+                    if isinstance(result, StabilityAPIError) and is_key_error(result):
+                        self.disabled[key] = f"HTTP {result.status_code}"
+                    elif not isinstance(result, Exception) and result > 0:
+                        self.disabled.pop(key, None)
+            if callback:
+                callback(results)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+key_pools = {}
+key_pools_lock = threading.Lock()
+
+def get_key_pool(text):
+    # 同一组 Key 共用一个池，停用状态和负载在任务之间保留
+    keys = tuple(parse_api_keys(text))
+    with key_pools_lock:
+        if keys not in key_pools:
+            key_pools[keys] = ApiKeyPool(keys)
+        return key_pools[keys]
+
+def generate_with_key_pool(generate, args):
+    # settings["API_KEY"] 是配置中的 Key 列表；每次尝试把选中的 Key 放进设置副本，原参数保持不变以便重新提交
+    pool = get_key_pool(args[0]["API_KEY"])
+    credits = job_credits(args)
+    while True:
+        key = pool.acquire(credits)
+        trace_update(api_key=mask_api_key(key))
+        try:
+            return generate(dict(args[0], API_KEY=key), *args[1:])
+        except StabilityAPIError as e:
+            if not is_key_error(e):
+                raise
+            pool.disable(key, f"HTTP {e.status_code}")
+            update_status(f"API key {mask_api_key(key)} was rejected ({e.status_code}), trying another key.")
+        finally:
+            pool.release(key)
+
+# 生成缓存：以请求内容的规范哈希为键，相同的请求直接复用已生成的图片，不再消耗积分
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+CACHE_REJECT_TTL = 7 * 24 * 3600
+MODERATION_ERRORS = {"content_moderation", "invalid_prompts"}
+
+def request_cache_key(url, data):
+    # seed 为 0 时由服务端随机生成，结果不可复现，不缓存
+    if not data.get("seed"):
+        return None
+    canonical = json.dumps({"url": url, "data": data}, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def prompt_cache_key(*prompts):
+    canonical = json.dumps([" ".join(prompt.split()).lower() for prompt in prompts], ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def link_or_copy(source, destination):
+    temp_path = f"{destination}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+
+class GenerationCache:
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES, reject_ttl=CACHE_REJECT_TTL):
+        self.directory = directory
+        self.index_file = os.path.join(directory, 'index.json')
+        self.max_bytes = max_bytes
+        self.reject_ttl = reject_ttl
+        self.entries = None  # 按最近使用排序
+        self.rejected = None
+        self.index_version = None  # 上次读写的索引文件 (inode, mtime, size)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        # 多个进程（两个脚本窗口、后台服务、命令行）共用缓存目录：每次读写索引都加文件锁，
+        # 并先读取磁盘上的最新索引，避免各自覆盖对方的条目
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock, locked_file(self.index_file + ".lock"):
+            self._load()
+            yield
+
+    def _index_version(self):
+        try:
+            stat = os.stat(self.index_file)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        version = self._index_version()
+        if self.entries is not None and version == self.index_version:
+            return
+        self.entries = collections.OrderedDict()
+        self.rejected = {}
+        self.index_version = version
+        try:
+            with open(self.index_file, 'r') as file:
+                index = json.load(file)
+            entries = [item for item in index.get("entries", {}).items() if "files" in item[1]]
+            self.entries.update(sorted(entries, key=lambda item: item[1].get("used", 0)))
+            self.rejected = index.get("rejected", {})
+        except (OSError, ValueError) as e:
+            if os.path.exists(self.index_file):
+                print(f"Error loading cache index: {e}")
+
+    def _save(self):
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(fd, 'w') as file:
+            json.dump({"entries": self.entries, "rejected": self.rejected}, file)
+        os.replace(temp_path, self.index_file)
+        self.index_version = self._index_version()
+
+    def _evict(self):
+        total = sum(entry["size"] for entry in self.entries.values())
+        while total > self.max_bytes and len(self.entries) > 1:
+            key, entry = self.entries.popitem(last=False)
+            total -= entry["size"]
+            for name in entry["files"]:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def lookup(self, key, allocate):
+        # 原输出文件还在就直接复用，否则把缓存副本恢复到新分配的输出文件
+        with self._locked_index():
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            cached_files = [os.path.join(self.directory, name) for name in entry["files"]]
+            if not all(os.path.isfile(path) for path in cached_files):
+                del self.entries[key]
+                self._save()
+                return None
+            for i, cached_file in enumerate(cached_files):
+                if not os.path.isfile(entry["sources"][i]):
+                    output_file = allocate()
+                    try:
+                        link_or_copy(cached_file, output_file)
+                    except OSError:
+                        release_output_file(output_file)
+                        raise
+                    entry["sources"][i] = output_file
+            entry["used"] = time.time()
+            self.entries.move_to_end(key)
+            self._save()
+            return list(entry["sources"])
+
+    def store(self, key, image_files):
+        os.makedirs(self.directory, exist_ok=True)
+        names = []
+        for i, image_file in enumerate(image_files):
+            names.append(f"{key}-{i}{os.path.splitext(image_file)[1]}")
+            link_or_copy(image_file, os.path.join(self.directory, names[-1]))
+        with self._locked_index():
+            size = sum(os.path.getsize(image_file) for image_file in image_files)
+            self.entries[key] = {"files": names, "sources": list(image_files), "size": size, "used": time.time()}
+            self.entries.move_to_end(key)
+            self._evict()
+            self._save()
+
+    def rejection(self, key):
+        with self._locked_index():
+            entry = self.rejected.get(key)
+            if entry and time.time() - entry["time"] > self.reject_ttl:
+                del self.rejected[key]
+                self._save()
+                entry = None
+            return entry["reason"] if entry else None
+
+    def reject(self, key, reason):
+        with self._locked_index():
+            self.rejected[key] = {"reason": reason, "time": time.time()}
+            self._save()
+
+generation_cache = GenerationCache(os.path.join(ENGINE_DIR, 'Stability_cache'))
+
+def cached_generation(url, data, allocate, *prompts):
+    # 返回 (cache_key, 已缓存的文件)；提示词曾被审核拒绝时抛出 StabilityAPIError
+    reason = generation_cache.rejection(prompt_cache_key(*prompts))
+    if reason:
+        raise StabilityAPIError(reason, name="content_moderation")
+    cache_key = request_cache_key(url, data)
+    if cache_key is None:
+        return None, None
+    try:
+        return cache_key, generation_cache.lookup(cache_key, allocate)
+    except OSError as e:
+        print(f"Error reading cache: {e}")
+        return cache_key, None
+
+def remember_generation(cache_key, output_files, error=None, *prompts):
+    try:
+        if error is not None:
+            if error.name in MODERATION_ERRORS:
+                generation_cache.reject(prompt_cache_key(*prompts), str(error))
+        elif cache_key:
+            generation_cache.store(cache_key, output_files)
+    except OSError as e:
+        print(f"Error writing cache: {e}")
+
+# 生成历史：每次生成写入本地 SQLite，用 FTS5 索引提示词；SQLite 未编译 FTS5 时退回 LIKE 查询
+HISTORY_FILE = os.path.join(ENGINE_DIR, 'Stability_history.db')
+HISTORY_PAGE_SIZE = 50
+
+class GenerationHistory:
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.fts = False
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        # 第一次查询或写入时才打开数据库
+        if self.connection is not None:
+            return self.connection
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS generations (
+                id INTEGER PRIMARY KEY,
+                created REAL NOT NULL,
+                model TEXT,
+                prompt TEXT,
+                negative_prompt TEXT,
+                seed INTEGER,
+                params TEXT,
+                latency REAL,
+                credits REAL,
+                output_path TEXT,
+                media_pool_item_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS generations_output_path ON generations(output_path);
+        """)
+        try:
+            created = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'generations_fts'").fetchone() is None
+            connection.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5(
+                    prompt, negative_prompt, content='generations', content_rowid='id'
+                );
+                CREATE TRIGGER IF NOT EXISTS generations_fts_insert AFTER INSERT ON generations BEGIN
+                    INSERT INTO generations_fts(rowid, prompt, negative_prompt) VALUES (new.id, new.prompt, new.negative_prompt);
+                END;
+            """)
+            if created:
+                # 没有 FTS5 时写入的旧记录补建索引
+                connection.execute("INSERT INTO generations_fts(generations_fts) VALUES ('rebuild')")
+                connection.commit()
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            print(f"FTS5 is not available, history search falls back to LIKE: {e}")
+        self.connection = connection
+        return connection
+
+    def record(self, model, prompt, negative_prompt, seed, params, latency, credits, output_files):
+        created = time.time()
+        params = json.dumps(params, sort_keys=True)
+        rows = [(created, model, prompt, negative_prompt, seed, params, latency, credits / len(output_files), path) for path in output_files]
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                    "INSERT INTO generations (created, model, prompt, negative_prompt, seed, params, latency, credits, output_path) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def set_media_pool_items(self, items):
+        # items: [(media_pool_item_id, output_path)]
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany("UPDATE generations SET media_pool_item_id = ? WHERE output_path = ?", items)
+
+    def search(self, query, before_id=None, limit=HISTORY_PAGE_SIZE):
+        # 键集分页：按 id 倒序取 before_id 之前的一页，翻到多深都只扫描一页
+        before_id = sys.maxsize if before_id is None else before_id
+        words = query.split()
+        columns = "g.id, g.created, g.model, g.seed, g.prompt, g.output_path"
+        with self.lock:
+            connection = self._connect()
+            if not words:
+                return connection.execute(
+                    f"SELECT {columns} FROM generations g WHERE g.id < ? ORDER BY g.id DESC LIMIT ?",
+                    (before_id, limit)).fetchall()
+            if self.fts:
+                # 每个词按前缀匹配，引号内的双引号需要转义
+                match = " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+                return connection.execute(
+                    f"SELECT {columns} FROM generations_fts f JOIN generations g ON g.id = f.rowid "
+                    "WHERE generations_fts MATCH ? AND f.rowid < ? ORDER BY f.rowid DESC LIMIT ?",
+                    (match, before_id, limit)).fetchall()
+            conditions = " AND ".join(["(g.prompt LIKE ? ESCAPE '\\' OR g.negative_prompt LIKE ? ESCAPE '\\')"] * len(words))
+            patterns = []
+            for word in words:
+                pattern = "%" + word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                patterns += [pattern, pattern]
+            return connection.execute(
+                f"SELECT {columns} FROM generations g WHERE {conditions} AND g.id < ? ORDER BY g.id DESC LIMIT ?",
+                patterns + [before_id, limit]).fetchall()
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+generation_history = GenerationHistory(HISTORY_FILE)
+
+# 运行指标：计数器、当前值，以及最近一段时间的生成记录（用来算每分钟图片数、延迟分位数和积分消耗速度）；
+# 界面定时读取快照，同一份数据也导出为 Prometheus 文本格式，供监控抓取
+METRICS_WINDOW = 300.0
+METRICS_FILE = os.path.join(ENGINE_DIR, 'Stability_metrics.prom')
+METRICS_QUANTILES = (0.5, 0.95)
+
+def percentile(values, fraction):
+    # 最近秩法，values 已排序
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+class MetricsRegistry:
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.started = time.monotonic()
+        self.counters = collections.Counter()  # 单调递增
+        self.gauges = collections.Counter()  # 当前值：排队、执行中
+        self.generations = collections.deque()  # (时间, 延迟或 None, 图片数, 积分)
+        self.lock = threading.Lock()
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def add_gauge(self, name, amount):
+        with self.lock:
+            self.gauges[name] += amount
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def record_generation(self, latency, images, credits, cached=False):
+        # 缓存命中计入图片数，但不参与延迟统计
+        with self.lock:
+            self.counters["generations"] += 1
+            self.counters["images"] += images
+            self.counters["credits"] += credits
+            if cached:
+                self.counters["cache_hits"] += 1
+            else:
+                self.counters["latency_seconds_sum"] += latency
+                self.counters["latency_count"] += 1
+            self.generations.append((time.monotonic(), None if cached else latency, images, credits))
+
+    def record_import(self, seconds, images):
+        with self.lock:
+            self.counters["imported_images"] += images
+            self.counters["import_seconds_sum"] += seconds
+            self.counters["import_count"] += 1
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.generations and now - self.generations[0][0] > self.window:
+                self.generations.popleft()
+            recent = list(self.generations)
+            snapshot = dict(self.counters)
+            snapshot.update(self.gauges)
+        # 刚启动时窗口还没填满，按实际经过的时间计算速率
+        minutes = max(1.0, min(self.window, now - self.started)) / 60
+        latencies = sorted(latency for _, latency, _, _ in recent if latency is not None)
+        snapshot["images_per_min"] = sum(images for _, _, images, _ in recent) / minutes
+        snapshot["credits_per_min"] = sum(credits for _, _, _, credits in recent) / minutes
+        for quantile in METRICS_QUANTILES:
+            snapshot[f"p{int(quantile * 100)}"] = percentile(latencies, quantile)
+        return snapshot
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = []
+        declared = set()
+
+        def metric(name, kind, help_text, value, labels=""):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# HELP stability_{name} {help_text}")
+                lines.append(f"# TYPE stability_{name} {kind}")
+            lines.append(f"stability_{name}{labels} {value}")
+
+        metric("jobs_queued", "gauge", "Generation jobs waiting for a worker.", snapshot.get("queued", 0))
+        metric("jobs_in_flight", "gauge", "Generation jobs currently running.", snapshot.get("in_flight", 0))
+        metric("concurrency_limit", "gauge", "Concurrent API requests allowed by the adaptive limiter.", snapshot.get("concurrency_limit", adaptive_concurrency.maximum))
+        metric("generations_total", "counter", "Successful generations, including cache hits.", snapshot.get("generations", 0))
+        metric("generation_failures_total", "counter", "Generation jobs that failed.", snapshot.get("failed", 0))
+        metric("offline_total", "counter", "Generation jobs deferred because the API was unreachable.", snapshot.get("offline", 0))
+        metric("cache_hits_total", "counter", "Generations served from the local cache.", snapshot.get("cache_hits", 0))
+        metric("images_total", "counter", "Images produced.", snapshot.get("images", 0))
+        metric("credits_spent_total", "counter", "Estimated credits spent.", round(snapshot.get("credits", 0.0), 2))
+        metric("images_imported_total", "counter", "Images imported into the media pool or Fusion.", snapshot.get("imported_images", 0))
+        for quantile in METRICS_QUANTILES:
+            value = snapshot[f"p{int(quantile * 100)}"]
+            metric("generation_latency_seconds", "summary", f"Generation latency over the last {int(self.window)} seconds, excluding cache hits.",
+                   "NaN" if value is None else round(value, 4), f'{{quantile="{quantile}"}}')
+        lines.append(f"stability_generation_latency_seconds_sum {round(snapshot.get('latency_seconds_sum', 0.0), 4)}")
+        lines.append(f"stability_generation_latency_seconds_count {snapshot.get('latency_count', 0)}")
+        metric("import_seconds_total", "counter", "Total time spent importing batches.", round(snapshot.get("import_seconds_sum", 0.0), 4))
+        metric("import_batches_total", "counter", "Import batches.", snapshot.get("import_count", 0))
+        metric("images_per_minute", "gauge", f"Images per minute over the last {int(self.window)} seconds.", round(snapshot["images_per_min"], 2))
+        metric("credits_per_minute", "gauge", f"Credits spent per minute over the last {int(self.window)} seconds.", round(snapshot["credits_per_min"], 2))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=METRICS_FILE):
+        # 抓取程序可能随时读取，写入临时文件后原子替换
+        try:
+            fd, temp_path = tempfile.mkstemp(prefix=".Stability_metrics-", suffix=".tmp", dir=os.path.dirname(path) or ".")
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                file.write(self.prometheus_text())
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Error writing metrics: {e}")
+
+metrics = MetricsRegistry()
+
+def record_generation(model, prompt, negative_prompt, seed, data, started, credits, output_files, cached=False):
+    metrics.record_generation(time.monotonic() - started, len(output_files), credits, cached)
+    trace_update(cached=cached)
+    # 历史写入失败不影响生成结果
+    try:
+        generation_history.record(model, prompt, negative_prompt, seed, data, time.monotonic() - started, credits, output_files)
+    except sqlite3.Error as e:
+        print(f"Error writing history: {e}")
+
+def generate_image_v1(settings, engine_id):
+    update_status("Generating image...")
+    started = time.monotonic()
+
+    url = f"{API_HOST}/v1/generation/{engine_id}/text-to-image"
+    trace_update(model=engine_id, images=settings["SAMPLES"])
+
+    def allocate(seed=None):
+        if seed is None:
+            return allocate_output_file(settings["OUTPUT_DIRECTORY"], engine_id, settings["SEED_V1"], "png", settings.get("SEQUENCE"))
+        return allocate_output_file(settings["OUTPUT_DIRECTORY"], engine_id, seed, "png")
+
+    data = {
+        "text_prompts": [{"text": settings["PROMPT_V1"]}],
+        "cfg_scale": settings["CFG_SCALE"],
+        "height": settings["HEIGHT"],
+        "width": settings["WIDTH"],
+        "samples": settings["SAMPLES"],
+        "steps": settings["STEPS"],
+        "seed": settings["SEED_V1"],
+        "sampler": settings["SAMPLER"]
+    }
+    if settings.get("STYLE_PRESET_V1")!="Default":
+        data["style_preset"] = settings["STYLE_PRESET_V1"]
+
+    samples = settings["SAMPLES"]
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "image/png" if samples == 1 else "application/json",
+    }
+
+    try:
+        cache_key, cached_files = cached_generation(url, data, allocate, settings["PROMPT_V1"])
+    except StabilityAPIError as e:
+        update_status("Prompt was rejected by content moderation before.")
+        print(f"Error: {e}")
+        return None
+    if cached_files:
+        update_status("Image loaded from cache.")
+        print(f"Cache hit: {cached_files}")
+        trace_update(cache_hit=True)
+        record_generation(engine_id, settings["PROMPT_V1"], '', settings["SEED_V1"], data, started, 0.0, cached_files, cached=True)
+        return cached_files
+
+    print("Sending request to URL:", url)
+    print("Request data:", json.dumps(data, indent=2))
+    
+    output_file = None
+    try:
+        if samples == 1:
+            output_file = allocate()
+            request_with_retry(get_http_session(settings['API_KEY']), "POST", url, headers=headers, json=data, stream=True,
+                               read_body=lambda response: save_response_to_file(response, output_file))
+            output_files = [output_file]
+        else:
+            # 一次请求返回全部图片
+            response = request_with_retry(get_http_session(settings['API_KEY']), "POST", url, headers=headers, json=data)
+            output_files = save_artifacts(response, allocate)
+    except StabilityAPIError as e:
+        release_output_file(output_file)
+        # API 不可用和 Key 无效（401/402）交给调用方：前者稍后重新提交，后者换一个 Key
+        if is_offline_error(e) or is_key_error(e):
+            raise
+        remember_generation(cache_key, None, e, settings["PROMPT_V1"])
+        update_status(f"Failed to generate image: {e.status_code or e.name}")
+        print(f"Error: {e}")
+        return None
+    except (requests.RequestException, OSError, ValueError) as e:
+        release_output_file(output_file)
+        update_status(f"Failed to generate image: {type(e).__name__}")
+        print(f"Error: {e}")
+        return None
+
+    credit_tracker.charge(settings['API_KEY'], engine_id, samples)
+    if not output_files:
+        update_status("No usable samples were returned.")
+        return None
+    record_generation(engine_id, settings["PROMPT_V1"], '', settings["SEED_V1"], data, started, estimate_credits(engine_id, samples), output_files)
+    if len(output_files) == samples:
+        remember_generation(cache_key, output_files)
+    if len(output_files) > 1:
+        update_status(f"{len(output_files)} images generated successfully.")
+    else:
+        update_status("Image generated successfully.")
+    print(f"Success: Images saved to {output_files}")
+    return output_files
+
+def generate_image_v2(settings):
+    update_status("Generating image...")
+    started = time.monotonic()
+
+    trace_update(model=settings["MODEL_V2"], images=1)
+
+    def allocate():
+        return allocate_output_file(settings["OUTPUT_DIRECTORY"], settings["MODEL_V2"], settings["SEED_V2"], settings["OUTPUT_FORMAT"], settings.get("SEQUENCE"))
+
+    url = ""
+    data = {
+        "prompt": settings["PROMPT_V2"],
+        "negative_prompt": settings["NEGATIVE_PROMPT"],
+        "seed": settings["SEED_V2"],
+        "aspect_ratio": settings["ASPECT_RATIO"],
+        "output_format": settings["OUTPUT_FORMAT"],
+    }
+
+    if settings["MODEL_V2"] == "ultra":
+        url = f"{API_HOST}/v2beta/stable-image/generate/ultra"
+
+    elif settings["MODEL_V2"] == "core":
+        url = f"{API_HOST}/v2beta/stable-image/generate/core"
+        if settings["STYLE_PRESET"]!="Default":
+            data["style_preset"] = settings["STYLE_PRESET"]
+
+    elif settings["MODEL_V2"] in ["sd3-large", "sd3-large-turbo","sd3-medium"]:
+        url = f"{API_HOST}/v2beta/stable-image/generate/sd3"
+        data["mode"] = "text-to-image"
+        data["model"] = settings["MODEL_V2"]
+    else:
+        update_status("Invalid model specified.")
+        return None
+
+    headers = {
+        "Accept": "image/*"
+    }
+
+    try:
+        cache_key, cached_files = cached_generation(url, data, allocate, settings["PROMPT_V2"], settings["NEGATIVE_PROMPT"])
+    except StabilityAPIError as e:
+        update_status("Prompt was rejected by content moderation before.")
+        print(f"Error: {e}")
+        return None
+    if cached_files:
+        update_status("Image loaded from cache.")
+        print(f"Cache hit: {cached_files}")
+        trace_update(cache_hit=True)
+        record_generation(settings["MODEL_V2"], settings["PROMPT_V2"], settings["NEGATIVE_PROMPT"], settings["SEED_V2"], data, started, 0.0, cached_files, cached=True)
+        return cached_files
+
+    print("Sending request to URL:", url)
+    print("Request data:", data)
+
+    output_file = None
+    try:
+        output_file = allocate()
+        request_with_retry(get_http_session(settings['API_KEY']), "POST", url, headers=headers, files={"none": ""}, data=data, stream=True,
+                           read_body=lambda response: save_response_to_file(response, output_file))
+    except StabilityAPIError as e:
+        release_output_file(output_file)
+        # API 不可用和 Key 无效（401/402）交给调用方：前者稍后重新提交，后者换一个 Key
+        if is_offline_error(e) or is_key_error(e):
+            raise
+        remember_generation(cache_key, None, e, settings["PROMPT_V2"], settings["NEGATIVE_PROMPT"])
+        update_status(f"Failed to generate image: {e.status_code or e.name}")
+        print(f"Error: {e}")
+        return None
+    except (requests.RequestException, OSError) as e:
+        release_output_file(output_file)
+        update_status(f"Failed to generate image: {type(e).__name__}")
+        print(f"Error: {e}")
+        return None
+
+    remember_generation(cache_key, [output_file])
+    credit_tracker.charge(settings['API_KEY'], settings["MODEL_V2"])
+    record_generation(settings["MODEL_V2"], settings["PROMPT_V2"], settings["NEGATIVE_PROMPT"], settings["SEED_V2"], data, started, estimate_credits(settings["MODEL_V2"]), [output_file])
+    update_status("Image generated successfully.")
+    print(f"Success: Image saved to {output_file}")
+    return [output_file]
+
+def parse_count(text, default=1, maximum=None):
+    count = int(text) if text.strip().isdigit() else default
+    count = max(1, count)
+    return min(count, maximum) if maximum else count
+
+def expand_batch(settings, prompt_key, seed_key, count, use_random_seed):
+    # 每行一个提示词，每个提示词生成 count 张；固定种子时依次递增
+    prompts = [line.strip() for line in settings[prompt_key].splitlines() if line.strip()]
+    jobs = []
+    for prompt in prompts or [settings[prompt_key]]:
+        for i in range(count):
+            job = dict(settings)
+            job[prompt_key] = prompt
+            if i > 0:
+                if use_random_seed:
+                    job[seed_key] = random.randint(0, 4294967295)
+                else:
+                    job[seed_key] = (settings[seed_key] + i) % 4294967296
+            jobs.append(job)
+    return jobs
+
+
+def is_offline_error(error):
+    # 网络故障、重试耗尽的 429/5xx 和熔断都说明 API 暂时不可用
+    return error.retryable or error.name == "circuit_open"
+
+class JobJournal:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, job_key, event, **fields):
+        record = {"job": job_key, "event": event, "time": time.time()}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            try:
+                with open(self.path, 'a', encoding='utf-8') as file:
+                    file.write(line)
+                    file.flush()
+                    os.fsync(file.fileno())
+            except OSError as e:
+                print(f"Error writing job journal: {e}")
+
+    def replay(self):
+        # 按任务合并记录，后写的字段覆盖先写的；崩溃时只写了一半的行直接跳过
+        jobs = collections.OrderedDict()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict) and "job" in record:
+                        jobs.setdefault(record["job"], {}).update(record)
+        except OSError as e:
+            if os.path.exists(self.path):
+                print(f"Error reading job journal: {e}")
+        return jobs
+
+    def compact(self, jobs):
+        # 只保留尚未结束的任务，写入临时文件后原子替换
+        with self.lock:
+            try:
+                fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(self.path))
+                with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                    for record in jobs.values():
+                        file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                print(f"Error compacting job journal: {e}")
+
+# 参数扫描：展开参数网格并发生成，全部完成后在本地拼接带标注的对比图
+MAX_SWEEP_JOBS = 100
+SAMPLERS = ['DDIM', 'DDPM', 'K_DPMPP_2M', 'K_DPMPP_2S_ANCESTRAL', 'K_DPM_2', 'K_DPM_2_ANCESTRAL', 'K_EULER', 'K_EULER_ANCESTRAL', 'K_HEUN', 'K_LMS']
+STYLE_PRESETS = ['Default', '3d-model', 'analog-film', 'anime', 'cinematic', 'comic-book', 'digital-art', 'enhance', 'fantasy-art', 'isometric', 'line-art', 'low-poly', 'modeling-compound', 'neon-punk', 'origami', 'photographic', 'pixel-art', 'tile-texture']
+CONTACT_THUMB_SIZE = 256
+CONTACT_LABEL_HEIGHT = 20
+sweep_fields_v1 = {
+    "seed": ("SEED_V1", int, None),
+    "cfg": ("CFG_SCALE", float, None),
+    "steps": ("STEPS", int, None),
+    "sampler": ("SAMPLER", str, SAMPLERS),
+}
+sweep_fields_v2 = {
+    "seed": ("SEED_V2", int, None),
+    "style": ("STYLE_PRESET", str, STYLE_PRESETS),
+}
+
+def parse_sweep(text, fields):
+    # 例如 "seed=1,2; cfg=5,7; sampler=*"，* 表示全部可选值
+    grid = []
+    for part in text.split(";"):
+        if not part.strip():
+            continue
+        if "=" not in part:
+            raise ValueError(f"expected name=values, got '{part.strip()}'")
+        name, values = part.split("=", 1)
+        name = name.strip().lower()
+        if name not in fields:
+            raise ValueError(f"unknown parameter '{name}'")
+        key, convert, all_values = fields[name]
+        values = [value.strip() for value in values.split(",") if value.strip()]
+        if values == ["*"] and all_values:
+            values = all_values
+        if not values:
+            raise ValueError(f"no values for '{name}'")
+        grid.append((name, key, [convert(value) for value in values]))
+    return grid
+
+def expand_sweep(jobs, grid, prompt_key):
+    multiple_prompts = len({job[prompt_key] for job in jobs}) > 1
+    swept = []
+    for job in jobs:
+        for combination in itertools.product(*[values for _, _, values in grid]):
+            swept_job = dict(job)
+            labels = [job[prompt_key][:24]] if multiple_prompts else []
+            for (name, key, _), value in zip(grid, combination):
+                swept_job[key] = value
+                labels.append(f"{name}={value}")
+            swept.append((swept_job, " ".join(labels)))
+    return swept
+
+def make_thumbnail(image_path):
+    # 每张原图只读取一次，draft 让 JPEG 直接按缩小尺寸解码
+    with Image.open(image_path) as image:
+        image.draft("RGB", (CONTACT_THUMB_SIZE, CONTACT_THUMB_SIZE))
+        image.thumbnail((CONTACT_THUMB_SIZE, CONTACT_THUMB_SIZE))
+        return image.convert("RGB")
+
+def compose_contact_sheet(thumbnails, labels, output_file):
+    columns = math.ceil(math.sqrt(len(thumbnails)))
+    rows = math.ceil(len(thumbnails) / columns)
+    cell_height = CONTACT_THUMB_SIZE + CONTACT_LABEL_HEIGHT
+    positions = []
+    for index, thumbnail in enumerate(thumbnails):
+        x = (index % columns) * CONTACT_THUMB_SIZE
+        y = (index // columns) * cell_height
+        if thumbnail is not None:
+            x += (CONTACT_THUMB_SIZE - thumbnail.width) // 2
+            y += (CONTACT_THUMB_SIZE - thumbnail.height) // 2
+        positions.append((x, y))
+
+    if np.available():
+        canvas = np.zeros((rows * cell_height, columns * CONTACT_THUMB_SIZE, 3), dtype=np.uint8)
+        for thumbnail, (x, y) in zip(thumbnails, positions):
+            if thumbnail is not None:
+                canvas[y:y + thumbnail.height, x:x + thumbnail.width] = np.asarray(thumbnail)
+        sheet = Image.fromarray(canvas)
+    else:
+        sheet = Image.new("RGB", (columns * CONTACT_THUMB_SIZE, rows * cell_height))
+        for thumbnail, position in zip(thumbnails, positions):
+            if thumbnail is not None:
+                sheet.paste(thumbnail, position)
+
+    draw = ImageDraw.Draw(sheet)
+    for index, (thumbnail, label) in enumerate(zip(thumbnails, labels)):
+        x = (index % columns) * CONTACT_THUMB_SIZE + 4
+        y = (index // columns) * cell_height + CONTACT_THUMB_SIZE + 4
+        draw.text((x, y), label if thumbnail is not None else f"{label} (failed)", fill=(230, 230, 230))
+    sheet.save(output_file, format="PNG")
+    return output_file
+
+def contact_sheet_supported():
+    return Image.available()
+
+# 命令行：不依赖 Resolve，把提示词批量生成为图片；使用 --resolve 时才加载 Resolve 插件导入媒体池
+V1_ENGINES = ("stable-diffusion-v1-6", "stable-diffusion-xl-1024-v1-0")
+V2_MODELS = ("ultra", "core", "sd3-large", "sd3-large-turbo", "sd3-medium")
+OUTPUT_FORMATS = ("png", "jpeg", "webp")
+
+def read_prompts(paths, prompts=()):
+    # 每行一个提示词，空行和 # 开头的行忽略；路径为 - 时读取标准输入
+    lines = list(prompts)
+    for path in paths:
+        if path == "-":
+            lines += sys.stdin.read().splitlines()
+        else:
+            with open(path, 'r', encoding='utf-8') as file:
+                lines += file.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.lstrip().startswith("#")]
+
+def build_cli_jobs(args, prompts):
+    # 构造与界面相同的设置字典，每个提示词按 --count 展开
+    seed = args.seed or random.randint(1, 4294967295)
+    if args.model in V1_ENGINES:
+        settings = {
+            "API_KEY": args.api_key,
+            "PROMPT_V1": "\n".join(prompts),
+            "SAMPLER": args.sampler,
+            "CFG_SCALE": args.cfg_scale,
+            "HEIGHT": args.height,
+            "WIDTH": args.width,
+            "STYLE_PRESET_V1": args.style_preset,
+            "SAMPLES": max(1, min(args.samples, MAX_SAMPLES)),
+            "STEPS": args.steps,
+            "SEED_V1": seed,
+            "OUTPUT_DIRECTORY": args.output,
+        }
+        jobs = expand_batch(settings, "PROMPT_V1", "SEED_V1", max(1, args.count), args.seed == 0)
+        return [(generate_image_v1, (job, args.model)) for job in jobs]
+    settings = {
+        "API_KEY": args.api_key,
+        "PROMPT_V2": "\n".join(prompts),
+        "NEGATIVE_PROMPT": args.negative_prompt,
+        "STYLE_PRESET": args.style_preset,
+        "ASPECT_RATIO": args.aspect_ratio,
+        "OUTPUT_FORMAT": args.output_format,
+        "MODEL_V2": args.model,
+        "SEED_V2": seed,
+        "OUTPUT_DIRECTORY": args.output,
+    }
+    jobs = expand_batch(settings, "PROMPT_V2", "SEED_V2", max(1, args.count), args.seed == 0)
+    return [(generate_image_v2, (job,)) for job in jobs]
+
+def run_jobs(jobs, concurrency):
+    # 按完成顺序产出 (参数, 图片路径列表或 None)；命令行没有导入阶段，生成结束即写入追踪记录
+    set_http_pool_size(max(HTTP_POOL_SIZE, concurrency))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
+        for generate, job_args in jobs:
+            trace = JobTrace()
+            queue_job()
+            futures[executor.submit(run_traced, trace, generate, job_args)] = (job_args, trace)
+        for future in as_completed(futures):
+            job_args, trace = futures[future]
+            try:
+                image_paths = future.result()
+            except StabilityAPIError as e:
+                # API 不可用时生成函数会抛出，命令行直接算作失败
+                update_status(f"[{trace.trace_id}] Failed to generate image: {e.status_code or e.name}")
+                print(f"Error: {e}")
+                image_paths = None
+            trace.finish("done" if image_paths else "failed")
+            yield job_args, image_paths
+
+def import_into_resolve(image_paths):
+    from stability_resolve import MediaPoolImporter, connect_resolve
+    try:
+        importer = MediaPoolImporter(connect_resolve())
+        importer.add(image_paths)
+        return bool(importer.flush(force=True))
+    except (ImportError, EnvironmentError, RuntimeError) as e:
+        print(f"Error importing into DaVinci Resolve: {e}")
+        return False
+
+def main(argv=None):
+    global API_HOST
+    parser = argparse.ArgumentParser(prog="stability_engine", description="Generate images with the Stability AI API without DaVinci Resolve.")
+    parser.add_argument("prompt_files", nargs="*", help="text files with one prompt per line, '-' reads standard input")
+    parser.add_argument("-p", "--prompt", action="append", default=[], help="prompt text, can be given more than once")
+    parser.add_argument("-o", "--output", required=True, help="directory for the generated images")
+    parser.add_argument("-m", "--model", default="core", choices=V2_MODELS + V1_ENGINES)
+    parser.add_argument("-n", "--count", type=int, default=1, help="images per prompt")
+    parser.add_argument("-j", "--concurrency", type=int, default=2, help=f"parallel requests (max {MAX_CONCURRENCY})")
+    parser.add_argument("--api-key", default=os.environ.get("STABILITY_API_KEY", ''), help="one or more comma separated keys, defaults to $STABILITY_API_KEY")
+    parser.add_argument("--api-host", help="defaults to $STABILITY_API_HOST or the public API")
+    parser.add_argument("--seed", type=int, default=0, help="0 picks a random seed")
+    parser.add_argument("--rate-limit", type=float, default=RATE_LIMIT, help="requests per second shared by all processes using the key, 0 disables")
+    parser.add_argument("--no-adaptive", action="store_true", help="keep concurrency fixed instead of halving it on 429 responses")
+    parser.add_argument("--negative-prompt", default='')
+    parser.add_argument("--style-preset", default="Default", choices=STYLE_PRESETS)
+    parser.add_argument("--aspect-ratio", default="1:1")
+    parser.add_argument("--output-format", default="png", choices=OUTPUT_FORMATS)
+    parser.add_argument("--width", type=int, default=512, help="V1 engines only")
+    parser.add_argument("--height", type=int, default=512, help="V1 engines only")
+    parser.add_argument("--cfg-scale", type=float, default=7.0, help="V1 engines only")
+    parser.add_argument("--steps", type=int, default=30, help="V1 engines only")
+    parser.add_argument("--sampler", default="DDIM", choices=SAMPLERS, help="V1 engines only")
+    parser.add_argument("--samples", type=int, default=1, help="V1 engines only, images per request")
+    parser.add_argument("--resolve", action="store_true", help="import the images into the running DaVinci Resolve project")
+    args = parser.parse_args(argv)
+
+    prompts = read_prompts(args.prompt_files, args.prompt)
+    if not prompts:
+        parser.error("no prompts given")
+    if not args.api_key:
+        parser.error("an API key is required (--api-key or STABILITY_API_KEY)")
+    if args.api_host:
+        API_HOST = args.api_host.rstrip("/")
+    set_rate_limit(args.rate_limit)
+    adaptive_concurrency.enabled = not args.no_adaptive
+    os.makedirs(args.output, exist_ok=True)
+
+    # 日志和状态写到 stderr，stdout 只输出图片路径，便于管道处理
+    stdout = sys.stdout
+    image_paths = []
+    failed = 0
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            for _, paths in run_jobs(build_cli_jobs(args, prompts), max(1, min(args.concurrency, MAX_CONCURRENCY))):
+                if not paths:
+                    failed += 1
+                    continue
+                image_paths += paths
+                for path in paths:
+                    print(path, file=stdout, flush=True)
+            if args.resolve and image_paths and not import_into_resolve(image_paths):
+                failed += 1
+        finally:
+            close_http_session()
+            generation_history.close()
+    print(f"{len(image_paths)} image(s) generated, {failed} failed.", file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,309 @@
+# DaVinci Resolve / Fusion 导入插件：把生成的图片导入媒体池、时间线或 Fusion 合成。
+# Resolve 脚本在界面中使用；命令行通过 --resolve 连接正在运行的 Resolve 时才会导入本模块
+import json
+import os
+import platform
+import re
+import sys
+import time
+
+# 记录上次找到 DaVinciResolveScript 和 python_get_resolve 的目录，下次启动直接加入 sys.path，
+# 不用先失败一次再探测安装路径
+RESOLVE_PATH_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Stability_resolve_path.json')
+
+def load_resolve_paths():
+    try:
+        with open(RESOLVE_PATH_CACHE, 'r') as file:
+            paths = json.load(file)
+    except (OSError, ValueError):
+        return []
+    if not isinstance(paths, list):
+        return []
+    return [path for path in paths if isinstance(path, str) and os.path.isdir(path)]
+
+def save_resolve_paths(cached_paths, *modules):
+    paths = sorted({os.path.dirname(os.path.abspath(module.__file__)) for module in modules if getattr(module, "__file__", None)})
+    if paths == sorted(cached_paths):
+        return
+    try:
+        with open(RESOLVE_PATH_CACHE, 'w') as file:
+            json.dump(paths, file)
+    except OSError as e:
+        print(f"Error caching DaVinciResolveScript path: {e}")
+
+def import_resolve_scripting():
+    cached_paths = load_resolve_paths()
+    for path in cached_paths:
+        if path not in sys.path:
+            sys.path.append(path)
+    try:
+        import DaVinciResolveScript as dvr_script
+        from python_get_resolve import GetResolve
+        print("DaVinciResolveScript from Python")
+    except ImportError:
+    
+        if platform.system() == "Darwin": 
+            resolve_script_path1 = "/Library/Application Support/Blackmagic Design/DaVinci Resolve/Developer/Scripting/Examples"
+            resolve_script_path2 = "/Library/Application Support/Blackmagic Design/DaVinci Resolve/Developer/Scripting/Modules"
+        elif platform.system() == "Windows": 
+            resolve_script_path1 = os.path.join(os.environ['PROGRAMDATA'], "Blackmagic Design", "DaVinci Resolve", "Support", "Developer", "Scripting", "Examples")
+            resolve_script_path2 = os.path.join(os.environ['PROGRAMDATA'], "Blackmagic Design", "DaVinci Resolve", "Support", "Developer", "Scripting", "Modules")
+        else:
+            raise EnvironmentError("Unsupported operating system")
+
+        sys.path.append(resolve_script_path1)
+        sys.path.append(resolve_script_path2)
+
+        try:
+            import DaVinciResolveScript as dvr_script
+            from python_get_resolve import GetResolve
+            print("DaVinciResolveScript from DaVinci")
+        except ImportError as e:
+            raise ImportError("Unable to import DaVinciResolveScript or python_get_resolve after adding paths") from e
+    save_resolve_paths(cached_paths, dvr_script, sys.modules.get(GetResolve.__module__))
+    return dvr_script, GetResolve
+
+def connect_resolve():
+    # 从 Resolve 外部连接需要在偏好设置中把外部脚本设为 Local
+    dvr_script, _ = import_resolve_scripting()
+    resolve = dvr_script.scriptapp("Resolve")
+    if resolve is None:
+        raise RuntimeError("DaVinci Resolve is not running or external scripting is disabled.")
+    return resolve
+
+# 媒体池导入：缓存项目、媒体池和 AiImage 文件夹句柄（切换项目时失效），
+# 并把一个刷新周期内完成的图片合并成一次 ImportMedia 调用
+IMPORT_FLUSH_INTERVAL = 0.5
+
+def notify_listeners(listeners, *args):
+    # 一个监听器出错（例如时间线放置时 Resolve 返回异常值）不影响其他监听器和导入结果
+    for listener in listeners:
+        try:
+            listener(*args)
+        except Exception as e:
+            print(f"Error in import listener: {e}")
+
+class MediaPoolImporter:
+    def __init__(self, resolve, folder_name="AiImage", flush_interval=IMPORT_FLUSH_INTERVAL):
+        self.resolve = resolve
+        self.folder_name = folder_name
+        self.flush_interval = flush_interval
+        self.project_manager = None
+        self.project_id = None
+        self.media_pool = None
+        self.folder = None
+        self.pending = []
+        self.pending_since = None
+        self.listeners = []
+        self.flush_listeners = []
+
+    def add_listener(self, listener):
+        # listener(media_pool, items)，每次导入后调用
+        self.listeners.append(listener)
+
+    def add_flush_listener(self, listener):
+        # listener(filenames, seconds, ok)，每次尝试导入后调用，耗时包含时间线放置等导入监听器
+        self.flush_listeners.append(listener)
+
+    def invalidate(self):
+        self.project_id = None
+        self.media_pool = None
+        self.folder = None
+
+    def _current_folder(self):
+        if self.project_manager is None:
+            self.project_manager = self.resolve.GetProjectManager()
+        project = self.project_manager.GetCurrentProject()
+        if project is None:
+            self.invalidate()
+            return None
+        project_id = project.GetUniqueId() if hasattr(project, "GetUniqueId") else project.GetName()
+        if project_id == self.project_id and self.folder is not None:
+            return self.folder
+
+        self.invalidate()
+        media_pool = project.GetMediaPool()
+        root_folder = media_pool.GetRootFolder()
+        # 检查 AiImage 文件夹是否已存在
+        folder = None
+        for sub_folder in root_folder.GetSubFolderList():
+            if sub_folder.GetName() == self.folder_name:
+                folder = sub_folder
+                break
+        if not folder:
+            folder = media_pool.AddSubFolder(root_folder, self.folder_name)
+        if not folder:
+            print(f"Failed to create or find {self.folder_name} folder.")
+            return None
+
+        print(f"{self.folder_name} folder is available: {folder.GetName()}")
+        self.project_id = project_id
+        self.media_pool = media_pool
+        self.folder = folder
+        return folder
+
+    def add(self, filenames):
+        if not self.pending:
+            self.pending_since = time.monotonic()
+        self.pending.extend(filenames)
+
+    def flush(self, force=False):
+        if not self.pending:
+            return []
+        if not force and time.monotonic() - self.pending_since < self.flush_interval:
+            return []
+        filenames, self.pending = self.pending, []
+        started = time.perf_counter()
+        try:
+            items = self._import(filenames)
+        except Exception as e:
+            # Resolve API 出错时按导入失败通知监听器，任务日志据此保留待导入状态
+            self.invalidate()
+            print(f"Error importing {len(filenames)} file(s) into the media pool: {e}")
+            items = []
+        notify_listeners(self.flush_listeners, filenames, time.perf_counter() - started, bool(items))
+        return items
+
+    def _import(self, filenames):
+        folder = self._current_folder()
+        if folder is None:
+            return []
+        self.media_pool.SetCurrentFolder(folder)
+        items = self.media_pool.ImportMedia(filenames, folder)
+        if not items:
+            # 文件夹可能已被删除，下次重新获取句柄
+            self.invalidate()
+            print(f"Failed to import {len(filenames)} file(s) into the media pool.")
+            return []
+        print(f"Imported {len(items)} file(s) into {self.folder_name}.")
+        notify_listeners(self.listeners, self.media_pool, items)
+        return items
+
+# Fusion 导入：一个刷新周期内的 Loader 在同一次 Lock 中创建并按网格排列；
+# 编号连续的帧批次只创建一个图像序列 Loader
+FUSION_GRID_COLUMNS = 8
+sequence_frame_pattern = re.compile(r"_(\d{4})\.[^.]+$")
+
+def is_frame_sequence(filenames):
+    frames = []
+    for filename in filenames:
+        match = sequence_frame_pattern.search(filename)
+        if not match:
+            return False
+        frames.append(int(match.group(1)))
+    return len(frames) > 1 and sorted(frames) == list(range(1, len(frames) + 1))
+
+class FusionLoaderBatcher:
+    def __init__(self, fusion, flush_interval=IMPORT_FLUSH_INTERVAL, columns=FUSION_GRID_COLUMNS):
+        self.fusion = fusion
+        self.flush_interval = flush_interval
+        self.columns = columns
+        self.pending = []
+        self.pending_since = None
+        self.sequences = {}  # name -> [剩余任务数, 已完成的文件]
+        self.ready_sequences = []
+        self.slot = 0
+        self.flush_listeners = []
+
+    def add_flush_listener(self, listener):
+        # listener(filenames, seconds, ok)，每次创建 Loader 后调用；帧序列报告全部帧
+        self.flush_listeners.append(listener)
+
+    def expect_sequence(self, name, count):
+        self.sequences[name] = [count, []]
+
+    def add(self, filenames, sequence=None):
+        if sequence in self.sequences:
+            # 失败的任务也会以空列表报告，保证序列能够结束
+            entry = self.sequences[sequence]
+            entry[0] -= 1
+            entry[1].extend(filenames)
+            if entry[0] <= 0:
+                del self.sequences[sequence]
+                self.ready_sequences.append(sorted(entry[1]))
+            return
+        if filenames and not self.pending:
+            self.pending_since = time.monotonic()
+        self.pending.extend(filenames)
+
+    def flush(self, force=False):
+        if force:
+            for _, filenames in self.sequences.values():
+                self.pending.extend(filenames)
+            self.sequences.clear()
+        if not self.pending and not self.ready_sequences:
+            return []
+        if not force and not self.ready_sequences and time.monotonic() - self.pending_since < self.flush_interval:
+            return []
+
+        clips = []
+        loaded = list(self.pending)
+        for filenames in self.ready_sequences:
+            loaded.extend(filenames)
+            if is_frame_sequence(filenames):
+                clips.append(filenames[0])
+            else:
+                clips.extend(filenames)
+        clips.extend(self.pending)
+        self.pending = []
+        self.ready_sequences = []
+        if not clips:
+            return []
+
+        started = time.perf_counter()
+        comp = self.fusion.GetCurrentComp()
+        loaders = []
+        comp.Lock()
+        try:
+            for clip in clips:
+                loader = comp.AddTool("Loader", self.slot % self.columns, self.slot // self.columns)
+                loader.Clip[comp.CurrentTime] = clip
+                loaders.append(loader)
+                self.slot += 1
+        finally:
+            comp.Unlock()
+            notify_listeners(self.flush_listeners, loaded, time.perf_counter() - started, bool(loaders))
+        print(f"Added {len(loaders)} Loader(s) to {comp.GetAttrs()['COMPS_Name']}.")
+        return loaders
+
+# 时间线放置：每次导入后用一次 AppendToTimeline 把图片依次放到播放头位置
+def timecode_to_frames(timecode, fps):
+    hours, minutes, seconds, frames = (int(part) for part in re.split(r"[:;.]", timecode))
+    rate = int(round(fps))
+    total = ((hours * 60 + minutes) * 60 + seconds) * rate + frames
+    if ";" in timecode:
+        # 丢帧时间码：除每第十分钟外，每分钟开头丢掉 2 帧（59.94 为 4 帧）
+        drop = int(round(fps * 0.066666))
+        total_minutes = hours * 60 + minutes
+        total -= drop * (total_minutes - total_minutes // 10)
+    return total
+
+class TimelinePlacer:
+    def __init__(self):
+        self.last_placement = None  # (timeline id, 放置时的播放头, 下一个空位)
+
+    def append(self, timeline, media_pool, items, track, duration):
+        fps = float(str(timeline.GetSetting("timelineFrameRate")).split()[0])
+        playhead = timecode_to_frames(timeline.GetCurrentTimecode(), fps)
+        timeline_id = timeline.GetUniqueId()
+        record_frame = playhead
+        # 播放头没动过时接在上一批之后，避免覆盖
+        if self.last_placement and self.last_placement[:2] == (timeline_id, playhead):
+            record_frame = self.last_placement[2]
+        while timeline.GetTrackCount("video") < track:
+            if not timeline.AddTrack("video"):
+                break
+        clip_infos = []
+        for index, item in enumerate(items):
+            clip_infos.append({
+                "mediaPoolItem": item,
+                "startFrame": 0,
+                "endFrame": duration - 1,
+                "mediaType": 1,
+                "trackIndex": track,
+                "recordFrame": record_frame + index * duration,
+            })
+        timeline_items = media_pool.AppendToTimeline(clip_infos)
+        self.last_placement = (timeline_id, playhead, record_frame + len(items) * duration)
+        print(f"Appended {len(timeline_items or [])} clip(s) to {timeline.GetName()} track {track}.")
+        return timeline_items
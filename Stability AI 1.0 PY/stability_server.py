@@ -0,0 +1,529 @@
+# 局域网任务服务器：多台工作站上的 Resolve 脚本把任务提交到这里，由一个进程统一生成。
+# API Key 只保存在服务器上，所有请求共用一个限流桶和 Key 池；生成缓存按请求内容共享，
+# 一位剪辑师的相同请求直接复用另一位的结果，同时进行的相同请求只发一次；
+# 各用户轮流分配生成线程，批量任务不会堵住其他人；结果写入服务器的结果目录，工作站通过 HTTP 取回后导入。
+#     python stability_server.py --api-key KEY1,KEY2 --users users.json --results-dir /srv/stability
+#     python mock_stability_server.py --port 8600 &
+#     python stability_server.py --api-host http://127.0.0.1:8600 --api-key test --port 8700
+# users.json 把访问令牌映射到用户名：{"令牌": "alice", ...}；工作站把令牌填在 API Key 一栏。
+# 不指定 --users 时不做认证，用户名取自请求头 X-Stability-User，只适合可信的局域网
+import argparse
+import collections
+import getpass
+import hashlib
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+import stability_engine as engine
+
+SERVER_PORT = 8700
+SERVER_CONCURRENCY = 4
+RESULTS_DIR = os.path.join(engine.ENGINE_DIR, 'Stability_results')
+RESULT_TTL = 24 * 3600
+MAX_WAIT = 30.0
+MAX_REQUEST_BYTES = 1024 * 1024
+GENERATORS = {generate.__name__: generate for generate in (engine.generate_image_v1, engine.generate_image_v2)}
+# 这些字段由服务器决定或只影响工作站本地，不参与相同请求的判断
+LOCAL_SETTINGS = ("API_KEY", "OUTPUT_DIRECTORY", "SEQUENCE")
+
+def request_fingerprint(generate_name, args):
+    # 随机种子（0）的请求每次结果不同，不合并
+    settings = args[0]
+    if not (settings.get("SEED_V1") or settings.get("SEED_V2")):
+        return None
+    canonical = [generate_name, {key: value for key, value in settings.items() if key not in LOCAL_SETTINGS}, list(args[1:])]
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def validate_args(generate_name, args):
+    # 设置来自局域网中的任意客户端：用在文件名和 URL 中的字段只接受已知值，种子必须是整数；
+    # 帧序列由工作站在下载时命名，服务器上不使用
+    settings = {key: value for key, value in dict(args[0]).items() if key != "SEQUENCE"}
+    if generate_name == "generate_image_v1":
+        if len(args) != 2 or args[1] not in engine.V1_ENGINES:
+            raise ValueError(f"Unknown engine {args[1:]}")
+        settings["SEED_V1"] = int(settings.get("SEED_V1", 0))
+    else:
+        if len(args) != 1 or settings.get("MODEL_V2") not in engine.V2_MODELS:
+            raise ValueError(f"Unknown model {settings.get('MODEL_V2')}")
+        if settings.get("OUTPUT_FORMAT") not in engine.OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {settings.get('OUTPUT_FORMAT')}")
+        settings["SEED_V2"] = int(settings.get("SEED_V2", 0))
+    return (settings,) + tuple(args[1:])
+
+class FairScheduler:
+    # 每个用户一个队列；空闲线程取执行中任务最少的用户，数量相同时取最久没有被服务的用户
+    def __init__(self):
+        self.queues = collections.OrderedDict()  # user -> deque of jobs
+        self.in_flight = collections.Counter()
+        self.served = {}
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def put(self, user, job):
+        with self.condition:
+            self.queues.setdefault(user, collections.deque()).append(job)
+            self.condition.notify()
+
+    def get(self):
+        with self.condition:
+            while not self.queues and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None, None
+            user = min(self.queues, key=lambda name: (self.in_flight[name], self.served.get(name, 0.0)))
+            queue = self.queues[user]
+            job = queue.popleft()
+            if not queue:
+                del self.queues[user]
+            self.in_flight[user] += 1
+            self.served[user] = time.monotonic()
+            return user, job
+
+    def done(self, user):
+        with self.condition:
+            self.in_flight[user] -= 1
+
+    def queued(self):
+        with self.condition:
+            return {user: len(queue) for user, queue in self.queues.items()}
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class JobServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, JobServerHandler)
+        self.options = options
+        self.api_keys = ",".join(engine.parse_api_keys(options.api_key))
+        self.users = {}
+        if options.users:
+            with open(options.users, 'r', encoding='utf-8') as file:
+                self.users = json.load(file)
+        self.scheduler = FairScheduler()
+        self.jobs = {}  # job_key -> 任务状态，结果保留 RESULT_TTL
+        self.running = {}  # 请求指纹 -> 正在生成的任务，相同请求的后来者挂在它下面
+        self.sequence = 0
+        self.credits = collections.Counter()  # user -> 估算消耗的积分
+        self.condition = threading.Condition()
+        engine.set_http_pool_size(max(engine.HTTP_POOL_SIZE, options.concurrency))
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(options.concurrency)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, user, request):
+        job_key = request["job_key"]
+        generate_name = request["generate"]
+        if generate_name not in GENERATORS:
+            raise ValueError(f"Unknown generator {generate_name}")
+        args = validate_args(generate_name, request["args"])
+        with self.condition:
+            job = self.jobs.get(job_key)
+            if job is not None:
+                if job["user"] != user:
+                    raise PermissionError("Job key belongs to another user")
+                # 工作站会用同一个 job_key 重新提交离线或失败的任务，这时重新排队，否则返回已有的状态
+                if job["state"] not in ("offline", "failed"):
+                    return job["state"]
+            trace = engine.JobTrace(job=job_key, user=user)
+            trace.trace_id = request.get("trace_id") or trace.trace_id
+            job = {"key": job_key, "user": user, "state": "queued", "trace": trace, "generate": GENERATORS[generate_name],
+                   "args": args, "fingerprint": request_fingerprint(generate_name, args), "followers": [], "result": None,
+                   "seq": None, "finished": None}
+            self.jobs[job_key] = job
+            leader = self.running.get(job["fingerprint"]) if job["fingerprint"] else None
+            if leader is not None:
+                # 相同的请求正在生成，等它的结果，不再占用积分和生成线程
+                leader["followers"].append(job)
+                return "queued"
+            if job["fingerprint"]:
+                self.running[job["fingerprint"]] = job
+        engine.queue_job()
+        self.scheduler.put(user, job)
+        return "queued"
+
+    def work(self):
+        while True:
+            user, job = self.scheduler.get()
+            if job is None:
+                return
+            try:
+                self.run(job)
+            except Exception as e:
+                # run 已经把任务记为失败，这里只保证工作线程不退出
+                print(f"Error running job {job['key']}: {e}", flush=True)
+            finally:
+                self.scheduler.done(user)
+
+    def run(self, job):
+        with self.condition:
+            job["state"] = "running"
+        image_paths, error, state = None, None, "failed"
+        try:
+            # 结果写入每个用户自己的目录；API Key 只在服务器上填入
+            settings = dict(job["args"][0], API_KEY=self.api_keys, OUTPUT_DIRECTORY=os.path.join(self.options.results_dir, safe_user_name(job["user"])))
+            os.makedirs(settings["OUTPUT_DIRECTORY"], exist_ok=True)
+            args = (settings,) + job["args"][1:]
+            image_paths = engine.run_traced(job["trace"], job["generate"], args)
+            state = "done" if image_paths else "failed"
+            if image_paths and not job["trace"].fields.get("cached"):
+                credits = engine.job_credits(args)
+                with self.condition:
+                    self.credits[job["user"]] += credits
+        except engine.StabilityAPIError as e:
+            image_paths, error = None, str(e)
+            state = "offline" if engine.is_offline_error(e) else "failed"
+        except Exception as e:
+            image_paths, error = None, str(e)
+            state = "failed"
+        finally:
+            # 无论出了什么错，任务和挂在它下面的相同请求都要有结果，否则长轮询的工作站会一直等待
+            print(f"[{job['trace'].trace_id}] {job['user']} job {job['key']}: {state}", flush=True)
+            with self.condition:
+                if self.running.get(job["fingerprint"]) is job:
+                    del self.running[job["fingerprint"]]
+                for finished in [job] + job["followers"]:
+                    self.finish(finished, state, image_paths, error, job["trace"])
+                self.condition.notify_all()
+
+    def finish(self, job, state, image_paths, error, trace):
+        # 调用方持有 condition
+        with trace.lock:
+            stages, fields = dict(trace.stages), dict(trace.fields)
+        self.sequence += 1
+        job["state"] = state
+        job["files"] = image_paths or []
+        job["seq"] = self.sequence
+        job["finished"] = time.monotonic()
+        job["result"] = {"job_key": job["key"], "state": state, "files": [os.path.basename(path) for path in job["files"]],
+                         "error": error, "stages": stages, "fields": fields, "seq": job["seq"]}
+
+    def attach(self, user, job_keys):
+        with self.condition:
+            return {job_key: self.jobs[job_key]["trace"].trace_id for job_key in job_keys
+                    if job_key in self.jobs and self.jobs[job_key]["user"] == user}
+
+    def results(self, user, after, wait):
+        # 长轮询：返回该用户 seq 大于 after 的结果；顺便清理过期的结果
+        deadline = time.monotonic() + min(wait, MAX_WAIT)
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                for job_key, job in list(self.jobs.items()):
+                    if job["finished"] is not None and now - job["finished"] > RESULT_TTL:
+                        del self.jobs[job_key]
+                results = [job["result"] for job in self.jobs.values() if job["user"] == user and job["seq"] is not None and job["seq"] > after]
+                if results or now >= deadline:
+                    return sorted(results, key=lambda result: result["seq"]), self.sequence
+                self.condition.wait(deadline - now)
+
+    def result_file(self, user, job_key, index):
+        with self.condition:
+            job = self.jobs.get(job_key)
+            if job is None or job["user"] != user or not 0 <= index < len(job.get("files", [])):
+                return None
+            return job["files"][index]
+
+    def status(self):
+        queued = self.scheduler.queued()
+        with self.condition:
+            users = {}
+            for job in self.jobs.values():
+                counts = users.setdefault(job["user"], {"queued": 0, "running": 0, "done": 0, "failed": 0, "offline": 0})
+                counts[job["state"]] += 1
+            for user, counts in users.items():
+                counts["waiting"] = queued.get(user, 0)
+                counts["credits"] = round(self.credits[user], 1)
+        return {"users": users, "workers": len(self.workers)}
+
+    def balance(self):
+        credits = 0.0
+        for key in engine.get_key_pool(self.api_keys).usable_keys():
+            try:
+                credits += engine.credit_tracker.fetch(key)
+            except engine.StabilityAPIError as e:
+                print(f"Error: {e}")
+        return round(credits, 1)
+
+def safe_user_name(user):
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", user) or "_"
+
+class JobServerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, {"error": message})
+
+    def authenticate(self):
+        # 返回用户名；令牌无效时回复 401 并返回 None
+        users = self.server.users
+        if not users:
+            return self.headers.get("X-Stability-User") or self.client_address[0]
+        token = self.headers.get("Authorization", "")[len("Bearer "):]
+        user = users.get(token)
+        if user is None:
+            self.send_error_json(401, "Invalid or missing access token")
+        return user
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REQUEST_BYTES:
+            raise ValueError("Request too large")
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/metrics":
+            body = engine.metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        user = self.authenticate()
+        if user is None:
+            return
+        server = self.server
+        file_match = re.match(r"^/v1/jobs/([0-9A-Za-z_-]+)/files/(\d+)$", url.path)
+        if url.path == "/v1/results":
+            try:
+                after, wait = int(query.get("after", ["0"])[0]), float(query.get("wait", ["0"])[0])
+            except ValueError as e:
+                self.send_error_json(400, f"Invalid request: {e}")
+                return
+            results, sequence = server.results(user, after, wait)
+            self.send_json(200, {"results": results, "seq": sequence})
+        elif file_match:
+            self.send_result_file(server.result_file(user, file_match.group(1), int(file_match.group(2))))
+        elif url.path == "/v1/status":
+            self.send_json(200, dict(server.status(), user=user))
+        elif url.path == "/v1/metrics":
+            self.send_json(200, {"metrics": engine.metrics.snapshot()})
+        elif url.path == "/v1/balance":
+            self.send_json(200, {"credits": server.balance()})
+        else:
+            self.send_error_json(404, f"Unknown path {url.path}")
+
+    def send_result_file(self, path):
+        if path is None or not os.path.isfile(path):
+            self.send_error_json(404, "No such result file")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(os.path.basename(path))}")
+        self.end_headers()
+        with open(path, 'rb') as file:
+            while True:
+                chunk = file.read(engine.DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        user = self.authenticate()
+        if user is None:
+            return
+        try:
+            request = self.read_json()
+            if url.path == "/v1/jobs":
+                self.send_json(202, {"state": self.server.submit(user, request)})
+            elif url.path == "/v1/jobs/attach":
+                self.send_json(200, {"jobs": self.server.attach(user, request.get("job_keys", []))})
+            else:
+                self.send_error_json(404, f"Unknown path {url.path}")
+        except PermissionError as e:
+            self.send_error_json(403, str(e))
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            self.send_error_json(400, f"Invalid request: {e}")
+
+# 客户端：Resolve 脚本中使用，接口与 stability_daemon.DaemonClient 相同。
+# 结果由后台线程长轮询取回，图片下载到提交任务时的本地输出目录后再交给脚本导入
+class JobServerClient:
+    def __init__(self, url, token=''):
+        self.url = url.rstrip("/")
+        self.session = engine.requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {token}", "X-Stability-User": getpass.getuser()})
+        self.jobs = {}  # job_key -> (本地输出目录, 帧序列)
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def request(self, method, path, timeout=10, **kwargs):
+        response = self.session.request(method, f"{self.url}{path}", timeout=timeout, **kwargs)
+        if response.status_code >= 400:
+            try:
+                message = response.json().get("error")
+            except ValueError:
+                message = response.text
+            raise RuntimeError(f"Job server returned {response.status_code}: {message}")
+        return response.json()
+
+    def ping(self):
+        return self.request("GET", "/v1/status")
+
+    def submit(self, job_key, trace_id, generate_name, args, workers):
+        # 并发数由服务器决定，workers 只为与 DaemonClient 保持相同的接口
+        settings = {key: value for key, value in args[0].items() if key not in LOCAL_SETTINGS}
+        with self.lock:
+            self.jobs[job_key] = (args[0]["OUTPUT_DIRECTORY"], args[0].get("SEQUENCE"))
+        return self.request("POST", "/v1/jobs", json={"job_key": job_key, "trace_id": trace_id, "generate": generate_name,
+                                                      "args": [settings] + list(args[1:])})
+
+    def attach(self, job_keys):
+        # job_keys 为 {job_key: 本地输出目录}，脚本重启后认领仍在服务器上的任务
+        known = self.request("POST", "/v1/jobs/attach", json={"job_keys": list(job_keys)})["jobs"]
+        with self.lock:
+            for job_key in known:
+                self.jobs[job_key] = (job_keys[job_key], None)
+        return known
+
+    def metrics(self):
+        return self.request("GET", "/v1/metrics")["metrics"]
+
+    def balance(self):
+        return self.request("GET", "/v1/balance", timeout=30)["credits"]
+
+    def download(self, job_key, index, name, directory, sequence=None):
+        if sequence:
+            # 帧序列中的一帧，与本地生成时的命名相同：<序列名>_0001.png
+            sequence_name, frame = sequence
+            name = f"{sequence_name}_{frame:04d}{os.path.splitext(name)[1]}"
+        path = reserve_local_file(directory, name)
+        temp_path = f"{path}.part"
+        try:
+            with self.session.get(f"{self.url}/v1/jobs/{job_key}/files/{index}", stream=True, timeout=60) as response:
+                if response.status_code != 200:
+                    raise RuntimeError(f"Job server returned {response.status_code} for {name}")
+                with open(temp_path, 'wb') as file:
+                    for chunk in response.iter_content(engine.DOWNLOAD_CHUNK_SIZE):
+                        file.write(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            engine.release_output_file(temp_path)
+            engine.release_output_file(path)
+            raise
+        return path
+
+    def listen(self, on_result, on_disconnect=None):
+        # on_result(result) 在后台线程中调用，result["files"] 已替换为本地路径；连续失败几次后调用 on_disconnect(error)
+        def listen_loop():
+            after = 0
+            failures = 0
+            error = None
+            while not self.closed:
+                try:
+                    response = self.request("GET", "/v1/results", timeout=MAX_WAIT + 10, params={"after": after, "wait": MAX_WAIT})
+                    failures = 0
+                except (OSError, RuntimeError, ValueError) as e:
+                    failures += 1
+                    error = e
+                    if failures >= 3:
+                        break
+                    time.sleep(2)
+                    continue
+                for result in response["results"]:
+                    after = max(after, result["seq"])
+                    with self.lock:
+                        local = self.jobs.pop(result["job_key"], None)
+                    if local is None:
+                        continue
+                    directory, sequence = local
+                    try:
+                        result["files"] = [self.download(result["job_key"], index, name, directory, sequence) for index, name in enumerate(result["files"])]
+                    except (OSError, RuntimeError) as e:
+                        print(f"Error downloading results of job {result['job_key']}: {e}")
+                        result.update(state="failed", files=[], error=str(e))
+                    try:
+                        on_result(result)
+                    except Exception as e:
+                        print(f"Error: {e}")
+            if not self.closed and on_disconnect:
+                on_disconnect(error)
+
+        threading.Thread(target=listen_loop, daemon=True).start()
+
+    def close(self):
+        self.closed = True
+        self.session.close()
+
+def reserve_local_file(directory, name):
+    # 相同的请求（合并或命中缓存）在服务器上返回同一个文件名，本地用 O_EXCL 预留，重名时加编号
+    stem, extension = os.path.splitext(name)
+    for attempt in itertools.count():
+        path = os.path.join(directory, name if attempt == 0 else f"{stem}-{attempt}{extension}")
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return path
+
+def connect_job_server(url, token=''):
+    client = JobServerClient(url, token)
+    client.ping()
+    return client
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="stability_server", description="Shared Stability AI job server for Resolve workstations on the LAN.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--api-key", default=os.environ.get("STABILITY_API_KEY", ''), help="one or more comma separated keys, defaults to $STABILITY_API_KEY")
+    parser.add_argument("--api-host", help="defaults to $STABILITY_API_HOST or the public API")
+    parser.add_argument("--users", help="JSON file mapping access tokens to user names; without it the server trusts X-Stability-User")
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument("-j", "--concurrency", type=int, default=SERVER_CONCURRENCY, help="generations running at the same time")
+    parser.add_argument("--rate-limit", type=float, default=engine.RATE_LIMIT, help="requests per second per key, 0 disables")
+    parser.add_argument("--no-adaptive", action="store_true", help="keep concurrency fixed instead of halving it on 429 responses")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    options = parser.parse_args(argv)
+
+    if not options.api_key:
+        parser.error("an API key is required (--api-key or STABILITY_API_KEY)")
+    if options.api_host:
+        engine.API_HOST = options.api_host.rstrip("/")
+    options.concurrency = max(1, options.concurrency)
+    engine.set_rate_limit(options.rate_limit)
+    engine.adaptive_concurrency.enabled = not options.no_adaptive
+    os.makedirs(options.results_dir, exist_ok=True)
+    server = JobServer((options.host, options.port), options)
+    print(f"Stability job server on http://{server.server_address[0]}:{server.server_address[1]}, "
+          f"{len(engine.parse_api_keys(options.api_key))} key(s), {options.concurrency} worker(s), "
+          f"{'open access' if not server.users else f'{len(server.users)} user(s)'}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.scheduler.close()
+        server.server_close()
+        engine.close_http_session()
+        engine.generation_history.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())